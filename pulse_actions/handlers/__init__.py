@@ -0,0 +1,25 @@
+"""
+Handlers are imported the first time a message is routed to them since they
+pull in mozci, thclient and taskcluster. Whatever configures those modules is
+registered with before_first_handler() so it is deferred until then as well.
+"""
+import threading
+
+from pulse_actions.utils.startup import timed_import
+
+_LOCK = threading.Lock()
+# Functions to call before the first handler is imported
+_SETUP = []
+
+
+def before_first_handler(function):
+    _SETUP.append(function)
+
+
+def load_handler(name):
+    '''Return the handler module called name, importing it if needed.'''
+    # Messages can be routed concurrently from different lanes
+    with _LOCK:
+        while _SETUP:
+            _SETUP.pop(0)()
+        return timed_import('pulse_actions.handlers.{}'.format(name))
@@ -9,19 +9,26 @@ import logging
 
 from mozci import query_jobs
 from mozci.errors import MissingBuilderError
-from mozci.mozci import trigger_talos_jobs_for_build
-from mozci.platforms import get_buildername_metadata
+from mozci.mozci import trigger_range
+from mozci.platforms import (
+    build_talos_buildernames_for_repo,
+    determine_upstream_builder,
+    get_buildername_metadata,
+)
 from mozci.sources import buildjson
 
 from pulse_actions.utils.misc import filter_invalid_builders
+from pulse_actions.utils.trigger_executor import trigger_in_parallel
 
 LOG = logging.getLogger(__name__.split('.')[-1])
+# How many times we trigger the talos jobs of a PGO build
+TALOS_TIMES = 2
 
 
 def ignored(data):
     '''It determines if the request will be processed or not.'''
     try:
-        info = get_buildername_metadata(data['payload']['buildername'])
+        info = get_buildername_metadata(data.buildername)
         if info['build_type'] == "pgo" and \
            info['repo_name'] in ('mozilla-inbound', 'fx-team', 'autoland') and \
            info['platform_name'] != 'win64':
@@ -34,6 +41,15 @@ def ignored(data):
         return True
 
 
+def talos_buildernames(buildername):
+    '''Return the talos builders which test the build of buildername.'''
+    repo_name = get_buildername_metadata(buildername)['repo_name']
+    return [
+        talos for talos in build_talos_buildernames_for_repo(repo_name, pgo_only=True)
+        if determine_upstream_builder(talos) == buildername
+    ]
+
+
 def on_event(data, message, dry_run, **kwargs):
     """
     Whenever PGO builds are completed in mozilla-inbound or fx-team,
@@ -41,15 +57,14 @@ def on_event(data, message, dry_run, **kwargs):
     """
     if ignored(data):
         LOG.debug("'%s' with status %i. Nothing to be done.",
-                  data['payload']['buildername'], data['payload']['status'])
+                  data.buildername, data.status)
         return 0  # SUCCESS
 
     # Cleaning mozci caches
     buildjson.BUILDS_CACHE = {}
     query_jobs.JOBS_CACHE = {}
-    payload = data["payload"]
-    buildername = payload["buildername"]
-    revision = payload["revision"]
+    buildername = data.buildername
+    revision = data.revision
 
     # Treeherder can send us invalid builder names
     # https://bugzilla.mozilla.org/show_bug.cgi?id=1242038
@@ -58,12 +73,15 @@ def on_event(data, message, dry_run, **kwargs):
     if buildername is None:
         return -1  # FAILURE
 
-    status = trigger_talos_jobs_for_build(
-        buildername=buildername,
-        revision=revision,
-        times=2,
-        dry_run=dry_run
-    )
+    # Like mozci's trigger_talos_jobs_for_build but each builder is triggered in parallel
+    result = trigger_in_parallel([
+        (talos, trigger_range,
+         {'buildername': talos, 'revisions': [revision], 'times': TALOS_TIMES,
+          'dry_run': dry_run,
+          'extra_properties': {'mozci_request': {'type': 'trigger_talos_jobs_for_build',
+                                                 'times': TALOS_TIMES}}})
+        for talos in talos_buildernames(buildername)
+    ])
 
     LOG.info('We triggered talos jobs for the build.')
-    return status
+    return result.exit_code
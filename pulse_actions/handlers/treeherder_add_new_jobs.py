@@ -1,16 +1,21 @@
 import logging
 
 from pulse_actions.utils.misc import (
+    create_treeherder_client,
     filter_invalid_builders,
     whitelisted_users,
     TREEHERDER
 )
+from pulse_actions.utils import throttling
+from pulse_actions.utils.push_index import lookup_author, lookup_revision
+from pulse_actions.utils.records import intern_name
+from pulse_actions.utils.tc_scheduler import SCHEDULER_HOST, schedule_action_task
+from pulse_actions.utils.trigger_executor import trigger_in_parallel
 
 from mozci import TaskClusterBuildbotManager, query_jobs
 from mozci.mozci import trigger_job
 from mozci.sources import buildjson, buildbot_bridge
-from mozci.taskcluster import TaskClusterManager, is_taskcluster_label
-from thclient import TreeherderClient
+from mozci.taskcluster import is_taskcluster_label
 
 LOG = logging.getLogger(__name__.split('.')[-1])
 MEMORY_SAVING_MODE = True
@@ -26,25 +31,19 @@ def on_event(data, message, dry_run, treeherder_server_url, **kwargs):
         return 0  # SUCCESS
 
     # Grabbing data received over pulse
-    repo_name = data["project"]
-    requester = data["requester"]
-    resultset_id = data["resultset_id"]
+    repo_name = data.project
+    requester = data.requester
+    resultset_id = data.resultset_id
+    requested_jobs = [intern_name(job) for job in data.requested_jobs]
 
-    if "requested_jobs" in data:
-        requested_jobs = data["requested_jobs"]
-    else:
-        LOG.error("Appropriate job requests not found in the pulse message.")
-        return -1
-
-    treeherder_client = TreeherderClient(server_url=treeherder_server_url)
-    resultset = treeherder_client.get_resultsets(repo_name, id=resultset_id)[0]
-    revision = resultset["revision"]
-    author = resultset["author"]
+    treeherder_client = create_treeherder_client(treeherder_server_url)
+    revision = lookup_revision(treeherder_client, repo_name, resultset_id)
+    author = lookup_author(treeherder_client, repo_name, resultset_id)
 
     treeherder_link = TREEHERDER % {
         'treeherder_server_url': treeherder_server_url,
         'repo': repo_name,
-        'revision': resultset['revision']
+        'revision': revision
     }
     metadata = {
         'name': 'pulse_actions_graph',
@@ -66,8 +65,7 @@ def on_event(data, message, dry_run, treeherder_server_url, **kwargs):
         LOG.info("- {}".format(job))
 
     # This is empty strings in non-try pulse messages
-    # Remove support for `decisionTaskID` once bug 1286897 fixed.
-    decision_task_id = data.get('decision_task_id', data.get('decisionTaskID'))
+    decision_task_id = data.decision_task_id
 
     # Separate Buildbot buildernames from TaskCluster task labels
     if decision_task_id:
@@ -79,9 +77,11 @@ def on_event(data, message, dry_run, treeherder_server_url, **kwargs):
     # https://bugzilla.mozilla.org/show_bug.cgi?id=1242038
     buildernames = filter_invalid_builders(list(set(requested_jobs) - set(task_labels)))
 
-    # XXX: In the future handle return codes
+    # XXX: In the future handle the return code of the TaskCluster jobs
     add_taskcluster_jobs(task_labels, decision_task_id, repo_name, dry_run)
-    add_buildbot_jobs(repo_name, revision, buildernames, metadata, dry_run)
+    if buildernames:
+        # e.g. some BuildAPI triggers failed
+        return add_buildbot_jobs(repo_name, revision, buildernames, metadata, dry_run)
 
     return 0  # SUCCESS
 
@@ -105,11 +105,12 @@ def add_taskcluster_jobs(task_labels, decision_task_id, repo_name, dry_run):
             return -1
         else:
             try:
-                mgr = TaskClusterManager(dry_run=dry_run)
-                mgr.schedule_action_task(decision_id=decision_task_id,
-                                         action='action-task',
-                                         action_args={'decision_id': decision_task_id,
-                                                      'task_labels': ','.join(task_labels)})
+                # Requests for the same decision task are combined into one action task
+                schedule_action_task(decision_id=decision_task_id,
+                                     action='action-task',
+                                     action_args={'decision_id': decision_task_id,
+                                                  'task_labels': ','.join(task_labels)},
+                                     dry_run=dry_run)
             except Exception as e:
                 # XXX: Read the following article and determine if we need to improve this
                 # https://www.loggly.com/blog/exceptional-logging-of-exceptions-in-python
@@ -137,7 +138,8 @@ def add_buildbot_jobs(repo_name, revision, buildernames, metadata, dry_run):
 
     if builders_graph != {}:
         mgr = TaskClusterBuildbotManager(dry_run=dry_run)
-        mgr.schedule_graph(
+        throttling.controller(SCHEDULER_HOST).call(
+            mgr.schedule_graph,
             repo_name=repo_name,
             revision=revision,
             metadata=metadata,
@@ -152,7 +154,13 @@ def add_buildbot_jobs(repo_name, revision, buildernames, metadata, dry_run):
         #      https://github.com/mozilla/mozilla_ci_tools/issues/424
         LOG.info("We're going to schedule these builders via Buildapi.")
         # This is used for test jobs which need an existing Buildbot job to be scheduled
-        for buildername in other_builders_to_schedule:
-            trigger_job(revision, buildername, dry_run=dry_run)
+        result = trigger_in_parallel([
+            (buildername, trigger_job,
+             {'revision': revision, 'buildername': buildername, 'dry_run': dry_run})
+            for buildername in other_builders_to_schedule
+        ])
+        return result.exit_code
     else:
         LOG.info("We don't have anything to schedule through Buildapi")
+
+    return 0  # SUCCESS
@@ -60,20 +60,25 @@ Sample job from Treeherder:
 """
 import logging
 
-from pulse_actions.utils.misc import filter_invalid_builders
+from pulse_actions.utils.misc import create_treeherder_client, filter_invalid_builders
+from pulse_actions.utils.push_index import (
+    lookup_decision_task_id,
+    lookup_job,
+    lookup_revision,
+)
+from pulse_actions.utils.tc_scheduler import schedule_action_task
+from pulse_actions.utils.trigger_executor import call_buildapi
 
 from mozci import query_jobs
 from mozci.mozci import manual_backfill
 from mozci.sources import buildjson
-from mozci.taskcluster import TaskClusterManager
-from thclient import TreeherderClient
 
 LOG = logging.getLogger(__name__.split('.')[-1])
 
 
 def ignored(data):
     '''It determines if the job will be processed or not.'''
-    if data['action'].capitalize() == "Backfill":
+    if data.action.capitalize() == "Backfill":
         return False
     else:
         return True
@@ -93,24 +98,22 @@ def on_event(data, message, dry_run, treeherder_server_url, **kwargs):
     buildjson.BUILDS_CACHE = {}
     query_jobs.JOBS_CACHE = {}
 
-    treeherder_client = TreeherderClient(server_url=treeherder_server_url)
+    treeherder_client = create_treeherder_client(treeherder_server_url)
 
-    action = data['action'].capitalize()
-    job_id = data['job_id']
-    repo_name = data['project']
+    action = data.action.capitalize()
+    job_id = data.job_id
+    repo_name = data.project
     status = None
 
     # We want to know the status of the job we're processing
-    try:
-        job_info = treeherder_client.get_jobs(repo_name, id=job_id)[0]
-    except IndexError:
+    job_info = lookup_job(treeherder_client, repo_name, job_id)
+    if job_info is None:
         LOG.info("We could not find any job_info for repo_name: %s and "
                  "job_id: %s" % (repo_name, job_id))
         return exit_code
 
     # We want to know the revision associated for this job
-    result_set = treeherder_client.get_resultsets(repo_name, id=job_info["result_set_id"])[0]
-    revision = result_set["revision"]
+    revision = lookup_revision(treeherder_client, repo_name, job_info.result_set_id)
 
     link_to_job = '{}/#/jobs?repo={}&revision={}&selectedJob={}'.format(
         treeherder_server_url,
@@ -122,40 +125,21 @@ def on_event(data, message, dry_run, treeherder_server_url, **kwargs):
     # There are various actions that can be taken on a job, however, we currently
     # only process the backfill one
     if action == "Backfill":
-        if job_info["build_system_type"] == "taskcluster":
-            jobs = []
-            jobs_per_call = 250
-            offset = 0
-            while True:
-                results = treeherder_client.get_jobs(
-                    repo_name,
-                    push_id=job_info["result_set_id"],
-                    count=jobs_per_call,
-                    offset=offset
-                )
-                jobs += results
-                if (len(results) < jobs_per_call):
-                    break
-                offset += jobs_per_call
-
-            decision = [t for t in jobs if t["job_type_name"] == "Gecko Decision Task"][0]
-            details = treeherder_client.get_job_details(job_guid=decision["job_guid"])
-            inspect = [detail["url"] for detail in details if detail["value"] == "Inspect Task"][0]
-            # Pull out the taskId from the URL e.g.
-            # oN1NErz_Rf2DZJ1hi7YVfA from <tc_tools_site>/task-inspector/#oN1NErz_Rf2DZJ1hi7YVfA/
-            decision_id = inspect.partition("#")[-1].rpartition("/")[0]
-            mgr = TaskClusterManager(dry_run=dry_run)
-            mgr.schedule_action_task(decision_id=decision_id,
-                                     action="backfill",
-                                     action_args={"project": repo_name,
-                                                  "job": job_info["id"]})
+        if job_info.build_system_type == "taskcluster":
+            decision_id = lookup_decision_task_id(
+                treeherder_client, repo_name, job_info.result_set_id)
+            schedule_action_task(decision_id=decision_id,
+                                 action="backfill",
+                                 action_args={"project": repo_name,
+                                              "job": job_info.id},
+                                 dry_run=dry_run)
 
         else:
-            buildername = job_info["ref_data_name"]
+            buildername = job_info.ref_data_name
 
             LOG.info("{} action requested by {} for '{}'".format(
                 action,
-                data['requester'],
+                data.requester,
                 buildername,
             ))
             LOG.info('Request for {}'.format(link_to_job))
@@ -165,10 +149,11 @@ def on_event(data, message, dry_run, treeherder_server_url, **kwargs):
             if buildername is None:
                 LOG.info('Treeherder can send us invalid builder names.')
                 LOG.info('See https://bugzilla.mozilla.org/show_bug.cgi?id=1242038.')
-                LOG.warning('Requested job name "%s" is invalid.' % job_info['ref_data_name'])
+                LOG.warning('Requested job name "%s" is invalid.' % job_info.ref_data_name)
                 exit_code = -1  # FAILURE
             else:
-                exit_code = manual_backfill(
+                exit_code = call_buildapi(
+                    manual_backfill,
                     revision=revision,
                     buildername=buildername,
                     dry_run=dry_run,
@@ -1,10 +1,14 @@
 import logging
 
 from mozci import query_jobs
-from mozci.mozci import trigger_all_talos_jobs
+from mozci.mozci import trigger_range
 from mozci.ci_manager import BuildAPIManager
+from mozci.platforms import build_talos_buildernames_for_repo
 from mozci.sources import buildjson
-from thclient import TreeherderClient
+
+from pulse_actions.utils.misc import create_treeherder_client
+from pulse_actions.utils.push_index import lookup_revision
+from pulse_actions.utils.trigger_executor import call_buildapi, trigger_in_parallel
 
 LOG = logging.getLogger(__name__.split('.')[-1])
 
@@ -12,7 +16,7 @@ LOG = logging.getLogger(__name__.split('.')[-1])
 def ignored(data):
     '''Ite determines if the job will be processed or not.'''
     # We do not handle 'cancel_all' action right now, so skip it.
-    if data['action'] == "cancel_all":
+    if data.action == "cancel_all":
         return True
     else:
         return False
@@ -25,34 +29,38 @@ def on_event(data, message, dry_run, treeherder_server_url, **kwargs):
     # Cleaning mozci caches
     buildjson.BUILDS_CACHE = {}
     query_jobs.JOBS_CACHE = {}
-    repo_name = data["project"]
-    action = data["action"]
-    times = data["times"]
+    repo_name = data.project
+    action = data.action
+    times = data.times
     # Pulse gives us resultset_id, we need to get revision from it.
-    resultset_id = data["resultset_id"]
+    resultset_id = data.resultset_id
 
-    treeherder_client = TreeherderClient(server_url=treeherder_server_url)
+    treeherder_client = create_treeherder_client(treeherder_server_url)
 
     LOG.info("%s action requested by %s on repo_name %s with resultset_id: %s" % (
-        data['action'],
-        data["requester"],
-        data["project"],
-        data["resultset_id"])
+        data.action,
+        data.requester,
+        data.project,
+        data.resultset_id)
     )
-    revision = treeherder_client.get_resultsets(repo_name, id=resultset_id)[0]["revision"]
+    revision = lookup_revision(treeherder_client, repo_name, resultset_id)
 
     if action == "trigger_missing_jobs":
         mgr = BuildAPIManager()
-        mgr.trigger_missing_jobs_for_revision(repo_name, revision, dry_run=dry_run)
+        call_buildapi(mgr.trigger_missing_jobs_for_revision, repo_name, revision,
+                      dry_run=dry_run)
 
     elif action == "trigger_all_talos_jobs":
-        trigger_all_talos_jobs(
-            repo_name=repo_name,
-            revision=revision,
-            times=times,
-            priority=-1,
-            dry_run=dry_run
-        )
+        # Like mozci's trigger_all_talos_jobs but each builder is triggered in parallel
+        result = trigger_in_parallel([
+            (buildername, trigger_range,
+             {'buildername': buildername, 'revisions': [revision], 'times': times,
+              'dry_run': dry_run,
+              'extra_properties': {'mozci_request': {'type': 'trigger_all_talos_jobs',
+                                                     'times': times, 'priority': -1}}})
+            for buildername in build_talos_buildernames_for_repo(repo_name)
+        ])
+        return result.exit_code
     else:
         raise Exception(
             'We were not aware of the "{}" action. Please address the code.'.format(action)
@@ -0,0 +1,343 @@
+"""
+Load test the worker without a Pulse account.
+
+The real consumer path (mozillapulse consumers, kombu and the worker's message handling,
+including lanes if the config has them) runs against kombu's in-memory transport.
+Synthetic messages are published for each source of the config at the given rates;
+they are seeded from data/sample_queue.json (normalized build messages are made up
+since the sample has none).
+
+By default route() is replaced by a stand-in which takes --service-time milliseconds
+so the consumer and scheduling machinery can be measured offline; use --real-route
+to run the real handlers (they talk to the services they normally talk to). With
+--fake-services the real handlers talk to local stand-ins of those services instead
+(see utils/fake_services.py) and make the calls they would make outside of dry run mode,
+through the same throttling as the worker (see utils/throttling.py).
+
+We report the sustained throughput, the p50/p95/p99 end-to-end latency (publish to
+processed) and how the backlog grew. With --fake-services we also report the requests
+per endpoint and the API calls per message and per user request.
+"""
+import ast
+import json
+import logging
+import random
+import threading
+import time
+
+from argparse import ArgumentParser
+
+from kombu import Connection, Exchange, Producer
+from replay.replay import PulseReplayConsumer
+
+import pulse_actions.worker as worker
+
+from pulse_actions.utils import throttling
+from pulse_actions.utils.fake_services import (
+    redirect_to_fakes,
+    start_fake_services,
+    total_requests,
+)
+from pulse_actions.utils.lanes import LaneScheduler, create_lane_consumer, create_lanes
+from pulse_actions.utils.log_util import setup_logging
+
+LOG = None
+MEMORY_TRANSPORT = 'memory://'
+# The memory transport polls its queues; the default (1s) would dominate the latency
+POLLING_INTERVAL = 0.005
+# A routing key which matches the topic of each source in configs/worker.json
+ROUTING_KEYS = {
+    'manual_backfill': 'buildbot.mozilla-inbound.backfill',
+    'resultset_actions': 'buildbot.try',
+    'runnable': 'try',
+    'talos-jobs': 'build.mozilla-inbound.pgo',
+}
+TALOS_BUILDERNAMES = [
+    'Ubuntu VM 12.04 x64 mozilla-inbound pgo-build',
+    'WINNT 6.1 x86-64 mozilla-inbound pgo-build',
+    'Ubuntu VM 12.04 x64 mozilla-inbound build',
+]
+
+
+def load_samples(sample_file):
+    '''Return sample messages per source.'''
+    samples = dict((source, []) for source in ROUTING_KEYS)
+    with open(sample_file) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            data = ast.literal_eval(line)
+            if 'job_id' in data:
+                samples['manual_backfill'].append(data)
+            elif 'buildernames' in data or 'requested_jobs' in data:
+                samples['runnable'].append(data)
+            else:
+                samples['resultset_actions'].append(data)
+
+    for buildername in TALOS_BUILDERNAMES:
+        samples['talos-jobs'].append({
+            '_meta': {'exchange': 'exchange/build/normalized'},
+            'payload': {
+                'buildername': buildername,
+                'revision': 'a' * 40,
+                'status': 0,
+                'tree': 'mozilla-inbound',
+            },
+        })
+
+    return samples
+
+
+class Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.published = 0
+        self.user_requests = 0
+        self.latencies = []
+        # List of (seconds since start, backlog)
+        self.backlog = []
+
+    def record_published(self):
+        with self._lock:
+            self.published += 1
+
+    def record_processed(self, data, message):
+        with self._lock:
+            self.latencies.append(time.time() - message.headers['sent'])
+            if worker.find_handler(data, message)[1]:
+                self.user_requests += 1
+
+    def sample_backlog(self, elapsed):
+        with self._lock:
+            self.backlog.append((elapsed, self.published - len(self.latencies)))
+
+    def report(self, duration):
+        latencies = sorted(self.latencies)
+        LOG.info('Published {} and processed {} messages in {:.0f}s.'.format(
+            self.published, len(latencies), duration))
+        LOG.info('Sustained throughput: {:.2f} messages/s'.format(len(latencies) / duration))
+        if latencies:
+            for percentile in (50, 95, 99):
+                index = min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))
+                LOG.info('p{} latency: {:.3f}s'.format(percentile, latencies[index]))
+
+        if self.backlog:
+            backlogs = [backlog for _, backlog in self.backlog]
+            LOG.info('Backlog: {} at the end, {} at most, growing {:.2f} messages/s'.format(
+                backlogs[-1], max(backlogs), (backlogs[-1] - backlogs[0]) / duration))
+
+    def report_api_calls(self, services):
+        for name in sorted(services):
+            LOG.info(services[name].report())
+
+        calls = total_requests(services)
+        if self.latencies:
+            LOG.info('API calls per message: {:.2f}'.format(calls / float(len(self.latencies))))
+        if self.user_requests:
+            LOG.info('API calls per user request: {:.2f} (all calls over {} user requests)'.format(
+                calls / float(self.user_requests), self.user_requests))
+
+
+def _memory_connection():
+    return Connection(MEMORY_TRANSPORT, transport_options={'polling_interval': POLLING_INTERVAL})
+
+
+def declare_exchanges(connection, queue_config):
+    # Pulse owns the exchanges; the consumers only declare them passively
+    for source in queue_config['sources'].values():
+        Exchange(source['exchange'], type='topic')(connection).declare()
+
+
+def publish(queue_config, samples, rates, duration, stats):
+    '''Publish messages for each source following a Poisson process.'''
+    connection = _memory_connection()
+    producer = Producer(connection.channel())
+    start = time.time()
+    next_message = dict((source, start + random.expovariate(rate))
+                        for source, rate in rates.iteritems() if rate > 0)
+
+    while next_message:
+        source, when = min(next_message.iteritems(), key=lambda item: item[1])
+        if when - start > duration:
+            break
+
+        time.sleep(max(0, when - time.time()))
+        producer.publish(
+            random.choice(samples[source]),
+            exchange=queue_config['sources'][source]['exchange'],
+            routing_key=ROUTING_KEYS[source],
+            serializer='json',
+            headers={'sent': time.time()},
+        )
+        stats.record_published()
+        next_message[source] = when + random.expovariate(rates[source])
+
+
+def _bind(consumer):
+    '''Bind the consumer's queue to all of its sources.
+
+    kombu's virtual transport only keeps the first binding of a queue, so we add every
+    binding to the exchanges' tables ourselves; the consumer's own bindings become no-ops.
+    '''
+    channel = consumer.connection.default_channel
+    channel.queue_declare(queue=consumer.queue_name, durable=consumer.durable)
+    for exchange, topic in zip(consumer.exchange, consumer.topic):
+        table = channel.state.exchanges[exchange].setdefault('table', [])
+        table.append(channel.typeof(exchange).prepare_bind(
+            consumer.queue_name, exchange, topic, None))
+    channel.state.bindings[consumer.queue_name] = (consumer.exchange[0], consumer.topic[0], None)
+
+
+def _consume(consumer):
+    # listen() only connects if there is no connection yet
+    consumer.connection = _memory_connection()
+    _bind(consumer)
+    thread = threading.Thread(target=consumer.listen)
+    thread.daemon = True
+    thread.start()
+
+
+def start_consumers(queue_config, stats):
+    pulse_args = {'user': 'loadtest', 'password': 'loadtest'}
+
+    def processed(process):
+        def wrapper(data, message):
+            process(data, message)
+            stats.record_processed(data, message)
+        return wrapper
+
+    if 'lanes' not in queue_config:
+        sources = queue_config['sources'].values()
+        consumer = PulseReplayConsumer(
+            exchanges=[s['exchange'] for s in sources],
+            topic=[s['topic'] for s in sources],
+            callback=processed(worker.message_handler),
+            applabel=queue_config['applabel'],
+            **pulse_args
+        )
+        _consume(consumer)
+        return
+
+    # Same as worker.run_lanes()
+    lanes = create_lanes(queue_config)
+    scheduler = LaneScheduler(
+        lanes=lanes,
+        process_message=processed(worker.process_message),
+        workers=queue_config.get('pulse_actions', {}).get(
+            'lane_workers', sum(lane.concurrency for lane in lanes)),
+        # The in-memory transport does not mind acknowledging from another thread
+        acknowledge=lambda lane, message: worker.acknowledge(message),
+    )
+    scheduler.start()
+
+    for lane in lanes:
+        def callback(data, message, lane=lane):
+            scheduler.put(lane, data, message)
+
+        _consume(create_lane_consumer(queue_config=queue_config, lane=lane, callback=callback,
+                                      **pulse_args))
+
+
+def simulated_route(service_time):
+    def route(data, message, **kwargs):
+        time.sleep(random.expovariate(1.0 / service_time))
+    return route
+
+
+def run(config_file, sample_file, rates, duration, service_time, real_route, drain,
+        fake_services=None):
+    with open(config_file) as file:
+        queue_config = json.load(file)
+
+    services = None
+    if fake_services:
+        services = start_fake_services(fake_services)
+        redirect_to_fakes(services)
+        # Nothing reaches the real services
+        worker.CONFIG['dry_run'] = False
+    else:
+        worker.CONFIG['dry_run'] = True
+        if not real_route:
+            worker.route = simulated_route(service_time)
+
+    stats = Stats()
+    declare_exchanges(_memory_connection(), queue_config)
+    start_consumers(queue_config, stats)
+
+    publisher = threading.Thread(
+        target=publish, args=(queue_config, load_samples(sample_file), rates, duration, stats))
+    publisher.daemon = True
+    start = time.time()
+    publisher.start()
+
+    while publisher.is_alive():
+        time.sleep(1)
+        stats.sample_backlog(time.time() - start)
+
+    # Give the consumers a chance to catch up so the latencies include the slowest messages
+    deadline = time.time() + drain
+    while stats.published > len(stats.latencies) and time.time() < deadline:
+        time.sleep(0.1)
+
+    stats.report(time.time() - start)
+    if services is not None:
+        stats.report_api_calls(services)
+        throttling.report()
+
+
+def parse_rates(values):
+    rates = dict((source, 0.0) for source in ROUTING_KEYS)
+    rates.update({'talos-jobs': 10.0, 'manual_backfill': 0.5, 'resultset_actions': 0.5,
+                  'runnable': 0.5})
+    for value in values or []:
+        source, _, rate = value.partition('=')
+        if source not in ROUTING_KEYS:
+            raise ValueError('Unknown source {}'.format(source))
+        rates[source] = float(rate)
+    return rates
+
+
+def main(argv=None):
+    global LOG
+
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--config-file', dest='config_file', default='configs/worker.json')
+    parser.add_argument('--sample-file', dest='sample_file', default='data/sample_queue.json')
+    parser.add_argument('--duration', dest='duration', type=float, default=30,
+                        help='Seconds to publish messages for.')
+    parser.add_argument('--drain', dest='drain', type=float, default=30,
+                        help='Seconds we wait for the backlog to be processed once we stop '
+                             'publishing.')
+    parser.add_argument('--rate', dest='rates', action='append',
+                        help='Messages per second for a source, e.g. talos-jobs=20. '
+                             'It can be used multiple times.')
+    parser.add_argument('--service-time', dest='service_time', type=float, default=50,
+                        help='Average milliseconds the stand-in for route() takes.')
+    parser.add_argument('--real-route', action='store_true', dest='real_route',
+                        help='Process the messages with the real handlers.')
+    parser.add_argument('--fake-services', dest='fake_services',
+                        help='Config of the fake services the real handlers should talk to, '
+                             'e.g. configs/fake_services.json.')
+    parser.add_argument('--debug', action='store_true', dest='debug')
+    options = parser.parse_args(argv)
+
+    LOG = setup_logging(logging.DEBUG if options.debug else logging.INFO)
+    # Per message logging would drown the report
+    worker.LOG = logging.getLogger('pulse_actions.worker')
+    for name in ('pulse_actions.utils.lanes', 'pulse_actions.worker'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    run(
+        config_file=options.config_file,
+        sample_file=options.sample_file,
+        rates=parse_rates(options.rates),
+        duration=options.duration,
+        service_time=options.service_time / 1000.0,
+        real_route=options.real_route,
+        drain=options.drain,
+        fake_services=options.fake_services,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+Replay a corpus of Pulse messages in parallel and write down what the worker decided.
+
+The messages of --replay-file are spread across a pool of processes. Each process runs
+the real routing and handlers with every side effect captured (see utils/shadow.py).
+Use --record to save the responses of the services the handlers query and --playback to
+answer from them afterwards, so a run only depends on the corpus and the recordings.
+
+For each message we write a JSON line with the handler it was routed to, whether the
+handler ignores it, the scheduling calls it intended to make, the exit code reported
+for it and the error it raised, if any. Lines follow the order of the corpus so two runs
+can be compared with diff, or with --golden which reports the messages which differ.
+"""
+import ast
+import json
+import logging
+import multiprocessing
+import sys
+import threading
+import traceback
+
+from argparse import ArgumentParser
+
+from mock import Mock
+
+import pulse_actions.worker as worker
+
+from pulse_actions.handlers import load_handler
+from pulse_actions.utils import log_util, recordings
+from pulse_actions.utils.log_util import setup_logging
+from pulse_actions.utils.schemas import InvalidMessage
+from pulse_actions.utils.shadow import capture_side_effects, message_id, run_captured
+
+LOG = None
+FIELDS = ('id', 'handler', 'ignored', 'actions', 'exit_code', 'error')
+# Set in each process of the pool
+RECORDER = None
+INIT_ERROR = None
+_EXIT_CODE = threading.local()
+
+
+def read_corpus(path):
+    with open(path) as file:
+        return [ast.literal_eval(line) for line in file if line.strip()]
+
+
+def _capture_exit_code(end_request):
+    def wrapper(exit_code, **kwargs):
+        _EXIT_CODE.value = exit_code
+        return end_request(exit_code=exit_code, **kwargs)
+    return wrapper
+
+
+def _init_process(*args):
+    global INIT_ERROR
+
+    # The pool would keep replacing a process whose initializer raises
+    try:
+        _set_up_process(*args)
+    except Exception:
+        INIT_ERROR = traceback.format_exc()
+
+
+def _set_up_process(treeherder_server_url, record, playback, debug):
+    '''Set up the worker in each process of the pool.'''
+    global RECORDER
+
+    # The parent's handlers write through a thread which does not exist in this process
+    root = logging.getLogger()
+    root.handlers = []
+    logging.basicConfig(level=logging.DEBUG if debug else logging.WARNING)
+    # Per request logs are attached to the root logger
+    log_util.LOG = root
+    worker.LOG = logging.getLogger('pulse_actions.worker')
+
+    worker.configure_mozci(memory_saving=False)
+    # Like shadow mode we use dry run mode so a side effect we do not capture does nothing,
+    # even with --record which queries the live services
+    worker.CONFIG.update({
+        'acknowledge': False,
+        'dry_run': True,
+        'submit_to_treeherder': False,
+        'treeherder_server_url': treeherder_server_url,
+    })
+    worker.end_request = _capture_exit_code(worker.end_request)
+    capture_side_effects()
+
+    if record:
+        RECORDER = recordings.Recorder()
+        recordings.install(RECORDER)
+    elif playback:
+        recordings.install(recordings.Player(recordings.load(playback)))
+
+
+def _replay(item):
+    '''Route a message and return its outcome and the responses recorded meanwhile.'''
+    if INIT_ERROR is not None:
+        raise RuntimeError('We failed to set up the process:\n' + INIT_ERROR)
+
+    index, data = item
+    name, _ = worker.find_handler(data)
+    _EXIT_CODE.value = None
+    try:
+        ignored = bool(load_handler(name).ignored(worker.parse_event(name, data))) if name else None
+    except InvalidMessage:
+        # route() reports it as the error
+        ignored = None
+
+    actions, error = run_captured(
+        worker.route,
+        data=data,
+        message=Mock(),
+        dry_run=worker.CONFIG['dry_run'],
+        treeherder_server_url=worker.CONFIG['treeherder_server_url'],
+    )
+    outcome = {
+        'index': index,
+        'id': message_id(data),
+        'handler': name,
+        'ignored': ignored,
+        # The order of parallel triggers is not deterministic
+        'actions': sorted(actions, key=lambda action: json.dumps(action, sort_keys=True)),
+        'exit_code': _EXIT_CODE.value,
+        'error': error,
+    }
+
+    recorded = {}
+    if RECORDER is not None:
+        recorded, RECORDER.recordings = RECORDER.recordings, {}
+
+    return outcome, recorded
+
+
+def compare(outcomes, golden_path):
+    '''Log the messages whose outcome differs from the golden run and return how many.'''
+    with open(golden_path) as file:
+        golden = dict((record['index'], record) for record in map(json.loads, file))
+
+    differing = 0
+    for outcome in outcomes:
+        expected = golden.get(outcome['index'])
+        if expected is None:
+            LOG.warning('Message {} ({}) is not in the golden run.'.format(
+                outcome['index'], outcome['id']))
+            differing += 1
+            continue
+
+        fields = [field for field in FIELDS if outcome[field] != expected.get(field)]
+        if fields:
+            differing += 1
+            for field in fields:
+                LOG.warning('Message {} ({}): {} was {} and now is {}'.format(
+                    outcome['index'], outcome['id'], field,
+                    json.dumps(expected.get(field)), json.dumps(outcome[field])))
+
+    LOG.info('{} out of {} messages differ from {}.'.format(
+        differing, len(outcomes), golden_path))
+    return differing
+
+
+def run(replay_file, output, processes, treeherder_server_url, record=None, playback=None,
+        golden=None, debug=False):
+    messages = read_corpus(replay_file)
+    pool = multiprocessing.Pool(
+        processes=processes,
+        initializer=_init_process,
+        initargs=(treeherder_server_url, record, playback, debug),
+    )
+
+    outcomes = []
+    recorded = {}
+    try:
+        # imap() returns the outcomes in the order of the corpus
+        for outcome, responses in pool.imap(_replay, enumerate(messages)):
+            outcomes.append(outcome)
+            recorded.update(responses)
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(output, 'w') as file:
+        for outcome in outcomes:
+            file.write(json.dumps(outcome, sort_keys=True) + '\n')
+    LOG.info('Replayed {} messages with {} processes into {}.'.format(
+        len(outcomes), processes, output))
+
+    if record:
+        recordings.save(record, recorded)
+        LOG.info('Recorded {} responses into {}.'.format(len(recorded), record))
+
+    if golden:
+        return 1 if compare(outcomes, golden) else 0
+    return 0
+
+
+def main(argv=None):
+    global LOG
+
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--replay-file', dest='replay_file', default='data/sample_queue.json')
+    parser.add_argument('--output', dest='output', default='replay_outcomes.json',
+                        help='Where the outcome of each message is written.')
+    parser.add_argument('--golden', dest='golden',
+                        help='Output of a previous run to compare against.')
+    parser.add_argument('--processes', dest='processes', type=int,
+                        default=multiprocessing.cpu_count())
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument('--record', dest='record',
+                           help='Save the responses of the services into this file.')
+    recording.add_argument('--playback', dest='playback',
+                           help='Answer every request from a file saved with --record.')
+    parser.add_argument('--treeherder-server-url', dest='treeherder_server_url',
+                        default=worker.CONFIG['treeherder_server_url'])
+    parser.add_argument('--debug', action='store_true', dest='debug')
+    options = parser.parse_args(argv)
+
+    LOG = setup_logging(logging.DEBUG if options.debug else logging.INFO)
+    sys.exit(run(
+        replay_file=options.replay_file,
+        output=options.output,
+        processes=options.processes,
+        treeherder_server_url=options.treeherder_server_url,
+        record=options.record,
+        playback=options.playback,
+        golden=options.golden,
+        debug=options.debug,
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+This module keeps a persistent local copy of mozci's builders dataset (allthethings.json).
+
+valid_builder(), get_buildername_metadata() and buildbot_graph_builder() all read it
+through mozci's allthethings module, which downloads and parses it on every restart.
+We keep the parsed data in a marshal file next to the ETag and Last-Modified headers
+of the response. On startup the file is loaded (much faster than parsing the JSON)
+and handed to mozci; a background thread then revalidates it with a conditional request
+and swaps in the new data atomically if it has changed.
+
+If there is no cache yet and we fail to download the dataset, mozci fetches it itself as
+it would without a cache.
+"""
+import json
+import logging
+import marshal
+import os
+import threading
+import time
+
+import requests
+
+from pulse_actions.utils.startup import timed_import
+
+LOG = logging.getLogger(__name__)
+ALLTHETHINGS_URL = 'https://secure.pub.build.mozilla.org/builddata/reports/allthethings.json'
+DATA_FILENAME = 'allthethings.marshal'
+META_FILENAME = 'allthethings.meta.json'
+# Seconds between revalidations
+REVALIDATE_INTERVAL = 60 * 60
+
+
+def _write_atomically(path, write):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as file:
+        write(file)
+    # rename() is atomic; readers see either the old or the new file
+    os.rename(tmp_path, path)
+
+
+def _use_data(data):
+    '''Swap the data mozci uses to answer builder queries.'''
+    allthethings = timed_import('mozci.sources.allthethings')
+    # Assigning a module attribute is atomic; requests in flight keep the old data
+    allthethings.DATA = data
+
+
+class BuildersCache(object):
+    def __init__(self, cache_dir, url=ALLTHETHINGS_URL):
+        self.cache_dir = cache_dir
+        self.url = url
+        self.data_path = os.path.join(cache_dir, DATA_FILENAME)
+        self.meta_path = os.path.join(cache_dir, META_FILENAME)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path) as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, data, response):
+        _write_atomically(self.data_path, lambda file: marshal.dump(data, file))
+        meta = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'url': self.url,
+        }
+        _write_atomically(self.meta_path, lambda file: json.dump(meta, file))
+
+    def load(self):
+        '''Return the cached data or None if there is no usable cache.'''
+        if not os.path.exists(self.data_path) or self._read_meta().get('url') != self.url:
+            return None
+
+        start = time.time()
+        try:
+            with open(self.data_path, 'rb') as file:
+                data = marshal.load(file)
+        except (EOFError, ValueError, TypeError):
+            LOG.warning('The builders cache {} is corrupted.'.format(self.data_path))
+            return None
+
+        LOG.info('Loaded the builders cache in {:.2f}s.'.format(time.time() - start))
+        return data
+
+    def revalidate(self):
+        '''Return new data if the dataset has changed since we cached it, otherwise, None.'''
+        meta = self._read_meta() if os.path.exists(self.data_path) else {}
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        response = requests.get(self.url, headers=headers, timeout=60)
+        if response.status_code == 304:
+            LOG.debug('The builders cache is up to date.')
+            return None
+
+        response.raise_for_status()
+        data = response.json()
+        self._save(data, response)
+        LOG.info('The builders cache has been refreshed.')
+        return data
+
+
+class BuildersCacheRefresher(threading.Thread):
+    '''Revalidate the builders cache periodically and swap in new data.'''
+    def __init__(self, cache, interval=REVALIDATE_INTERVAL):
+        super(BuildersCacheRefresher, self).__init__(name='BuildersCacheRefresher')
+        self.daemon = True
+        self.cache = cache
+        self.interval = interval
+
+    def run(self):
+        while True:
+            try:
+                data = self.cache.revalidate()
+                if data is not None:
+                    _use_data(data)
+            except Exception:
+                # The cached data is still usable
+                LOG.exception('We failed to revalidate the builders cache.')
+
+            time.sleep(self.interval)
+
+
+def setup_builders_cache(cache_dir):
+    '''Hand the cached dataset to mozci and keep it fresh in the background.
+
+    Without a cache the dataset is fetched (and cached) before returning.
+    '''
+    cache = BuildersCache(cache_dir)
+    data = cache.load()
+    if data is None:
+        try:
+            data = cache.revalidate()
+        except Exception:
+            LOG.exception('We failed to download the builders dataset; mozci will fetch it.')
+
+    if data is not None:
+        _use_data(data)
+    # It also retries the download if it failed
+    BuildersCacheRefresher(cache).start()
+    return cache
@@ -0,0 +1,218 @@
+"""
+This module reloads the worker config without restarting the worker.
+
+ConfigWatcher re-reads the config file when it changes (we poll its modification time)
+or when the worker receives SIGHUP. The new config is validated before anything is
+applied; an invalid config is logged and the worker keeps running with the previous one.
+
+Bindings which were added or removed are applied to the live queues through a separate
+short-lived connection, so the consumers keep their connections and the worker keeps its
+warm caches. The consumers' lists of exchanges and topics are updated too so a
+reconnection declares the new bindings.
+
+Changing the applabel (of the worker or of a lane), the durability, the set of lanes,
+the number of lane workers or the push index needs a restart.
+"""
+import json
+import logging
+import os
+import signal
+import threading
+
+from pulse_actions.utils.connection import create_connection
+
+LOG = logging.getLogger(__name__)
+# Seconds between checks of the config file's modification time
+POLL_INTERVAL = 5
+# Keys of the 'pulse_actions' section which can be changed at runtime and their types
+RELOADABLE = {
+    'acknowledge': bool,
+    'route': bool,
+    'submit_to_treeherder': bool,
+    'treeherder_server_url': basestring,
+}
+
+
+def read_config(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def validate_config(queue_config):
+    '''Raise ValueError if the config cannot be used.'''
+    if not queue_config.get('applabel'):
+        raise ValueError('The config needs an applabel')
+
+    sources = queue_config.get('sources')
+    if not isinstance(sources, dict) or not sources:
+        raise ValueError('The config needs at least one source')
+
+    for name, source in sources.iteritems():
+        for key in ('exchange', 'topic'):
+            if not isinstance(source.get(key), basestring):
+                raise ValueError('The source {} needs an {}'.format(name, key))
+
+    lanes = queue_config.get('lanes')
+    if lanes is not None:
+        for name, source in sources.iteritems():
+            if source.get('lane') not in lanes:
+                raise ValueError('The source {} does not belong to any of the lanes {}'.format(
+                    name, lanes.keys()))
+
+        for name, lane in lanes.iteritems():
+            for key in ('concurrency', 'weight'):
+                if not isinstance(lane.get(key), int) or lane[key] < 1:
+                    raise ValueError('The lane {} needs a positive {}'.format(name, key))
+
+            if not isinstance(lane.get('applabel', ''), basestring):
+                raise ValueError('The applabel of the lane {} should be a string'.format(name))
+
+            # A queue without bindings would never receive anything
+            if not any(source['lane'] == name for source in sources.values()):
+                raise ValueError('The lane {} has no sources'.format(name))
+
+    for key, value in queue_config.get('pulse_actions', {}).iteritems():
+        if key in RELOADABLE and not isinstance(value, RELOADABLE[key]):
+            raise ValueError('pulse_actions.{} has the wrong type: {!r}'.format(key, value))
+
+
+def restart_required(old_config, new_config):
+    '''Return the changes which cannot be applied to a running worker.'''
+    reasons = []
+    for key in ('applabel', 'durable', 'index'):
+        if old_config.get(key) != new_config.get(key):
+            reasons.append('{} changed'.format(key))
+
+    old_lanes = old_config.get('lanes', {})
+    new_lanes = new_config.get('lanes', {})
+    if sorted(old_lanes) != sorted(new_lanes):
+        reasons.append('the lanes changed')
+    elif any(old_lanes[name].get('applabel') != new_lanes[name].get('applabel')
+             for name in old_lanes):
+        reasons.append('the applabel of a lane changed')
+
+    old_workers = old_config.get('pulse_actions', {}).get('lane_workers')
+    if old_workers != new_config.get('pulse_actions', {}).get('lane_workers'):
+        reasons.append('lane_workers changed')
+
+    return reasons
+
+
+def config_changes(old_config, new_config):
+    '''Return the reloadable values of the 'pulse_actions' section which changed.
+
+    Only the values which changed in the file are returned so values which were
+    set from the command line are kept until the file changes them.
+    '''
+    old = old_config.get('pulse_actions', {})
+    new = new_config.get('pulse_actions', {})
+    return dict(
+        (key, new[key]) for key in RELOADABLE
+        if key in new and new[key] != old.get(key)
+    )
+
+
+def bindings(queue_config, lane=None):
+    '''Return the (exchange, topic) of every source, or only those of a lane.'''
+    return sorted(
+        (source['exchange'], source['topic'])
+        for source in queue_config['sources'].values()
+        if lane is None or source['lane'] == lane
+    )
+
+
+def update_bindings(consumer, new_bindings):
+    '''Bind and unbind the consumer's queue so it matches new_bindings.'''
+    old_bindings = zip(consumer.exchange, consumer.topic)
+    added = [b for b in new_bindings if b not in old_bindings]
+    removed = [b for b in old_bindings if b not in new_bindings]
+    if not added and not removed:
+        return
+
+    # The consumer's channel belongs to the thread draining its events
+    connection = create_connection(consumer.config)
+    try:
+        channel = connection.channel()
+        for exchange, topic in added:
+            # Pulse owns the exchanges
+            channel.exchange_declare(exchange=exchange, type='topic', passive=True)
+            channel.queue_bind(queue=consumer.queue_name, exchange=exchange, routing_key=topic)
+            LOG.info('{}: bound to ({}, {})'.format(consumer.queue_name, exchange, topic))
+
+        for exchange, topic in removed:
+            channel.queue_unbind(queue=consumer.queue_name, exchange=exchange, routing_key=topic)
+            LOG.info('{}: unbound from ({}, {})'.format(consumer.queue_name, exchange, topic))
+    finally:
+        connection.release()
+
+    consumer.exchange = [exchange for exchange, _ in new_bindings]
+    consumer.topic = [topic for _, topic in new_bindings]
+
+
+class ConfigWatcher(threading.Thread):
+    def __init__(self, path, config, apply, interval=POLL_INTERVAL):
+        '''
+        :param config: The config the worker is running with
+        :param apply: Function called with the old and the new config once it is valid
+        '''
+        super(ConfigWatcher, self).__init__(name='ConfigWatcher')
+        self.daemon = True
+        self.path = path
+        self.config = config
+        self.apply = apply
+        self.interval = interval
+        self._mtime = os.path.getmtime(path)
+        self._reload_requested = threading.Event()
+
+    def request_reload(self, *args):
+        '''Signal handler to reload the config.'''
+        self._reload_requested.set()
+
+    def install_signal_handler(self, signum=signal.SIGHUP):
+        # It can only be called from the main thread
+        signal.signal(signum, self.request_reload)
+        # Restart the system calls it interrupts, e.g. reading from the Pulse connection
+        signal.siginterrupt(signum, False)
+
+    def _changed(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            # It is being replaced
+            return False
+
+        changed = mtime != self._mtime
+        self._mtime = mtime
+        return changed
+
+    def run(self):
+        while True:
+            self._reload_requested.wait(self.interval)
+            # Always check so a signal for a change which was also written is only applied once
+            changed = self._changed()
+            if self._reload_requested.is_set() or changed:
+                self._reload_requested.clear()
+                self.reload()
+
+    def reload(self):
+        try:
+            new_config = read_config(self.path)
+            validate_config(new_config)
+        except (IOError, ValueError) as e:
+            LOG.error('Ignoring the new config in {}: {}'.format(self.path, e))
+            return
+
+        reasons = restart_required(self.config, new_config)
+        if reasons:
+            LOG.error('Ignoring the new config in {}; restart the worker since {}.'.format(
+                self.path, ', '.join(reasons)))
+            return
+
+        try:
+            self.apply(self.config, new_config)
+        except Exception:
+            LOG.exception('Failed to apply the new config in {}.'.format(self.path))
+            return
+
+        self.config = new_config
+        LOG.info('Reloaded the config from {}.'.format(self.path))
@@ -0,0 +1,181 @@
+"""
+This module keeps the connection of a Pulse consumer alive.
+
+mozillapulse's listen() rebuilds everything in an endless loop without any backoff.
+ConnectionManager instead opens the AMQP connection with heartbeats, checks them
+after every event it drains and reconnects with jittered exponential backoff when the
+connection drops or the queue is cleared. Reads interrupted by a signal handler (SIGHUP,
+SIGUSR2) are retried instead of being taken for a lost connection. Callbacks which block
+the consuming thread (e.g. routing a message synchronously or waiting for a full lane)
+keep our heartbeats going with keepalive() or run_blocking(). Other threads hand what
+has to run on the consuming thread (e.g. acknowledging a message) to call_soon(). The queue
+and its bindings are declared again from the consumer's configuration (these declarations
+are idempotent).
+
+For every reconnection we log how long we were disconnected and how many messages
+had piled up in the queue.
+"""
+import errno
+import logging
+import random
+import socket
+import threading
+import time
+
+from collections import deque
+
+from amqp.exceptions import ConsumerCancelled
+from kombu import Connection
+
+LOG = logging.getLogger(__name__)
+# Seconds; the broker considers the connection dead after missing two heartbeats
+HEARTBEAT = 30
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# Seconds between runs of the functions handed to call_soon() while the queue is idle
+CALL_INTERVAL = 1
+
+
+def jittered_backoff(attempt):
+    '''Return the seconds to wait before reconnecting ("full jitter").'''
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def create_connection(config, heartbeat=0):
+    '''Return a kombu Connection to the broker of a mozillapulse configuration.'''
+    return Connection(
+        hostname=config.host,
+        port=config.port,
+        userid=config.user,
+        password=config.password,
+        virtual_host=config.vhost,
+        ssl=config.ssl,
+        heartbeat=heartbeat,
+    )
+
+
+class ConnectionManager(object):
+    def __init__(self, consumer, heartbeat=HEARTBEAT, on_disconnect=None):
+        '''
+        :param on_disconnect: Called when the connection drops, e.g. to forget the messages
+                              which Pulse will deliver again
+        '''
+        self.consumer = consumer
+        self.heartbeat = heartbeat
+        self.on_disconnect = on_disconnect
+        # Functions (and their arguments) the consuming thread has to call
+        self._calls = deque()
+        # Statistics
+        self.reconnections = 0
+        self.last_disconnection = None
+        self._disconnected_at = None
+        self._failed_attempts = 0
+        self._last_keepalive = 0
+
+    def _connect(self):
+        # Replace the connection mozillapulse created since it has no heartbeats
+        self.consumer.disconnect()
+        self.consumer.connection = create_connection(self.consumer.config, self.heartbeat)
+        self.consumer.connection.ensure_connection(max_retries=1)
+
+    def _connected(self, kombu_consumer):
+        self._failed_attempts = 0
+        if self._disconnected_at is None:
+            LOG.info('Connected to {}'.format(self.consumer.queue_name))
+            return
+
+        self.reconnections += 1
+        self.last_disconnection = time.time() - self._disconnected_at
+        self._disconnected_at = None
+        # A passive declaration tells us how many messages are waiting
+        _, messages_behind, _ = kombu_consumer.queues[0].queue_declare(passive=True)
+        LOG.info('Reconnected to {} after {:.1f}s; {} messages are waiting.'.format(
+            self.consumer.queue_name, self.last_disconnection, messages_behind))
+
+    def _disconnected(self):
+        if self._disconnected_at is None:
+            self._disconnected_at = time.time()
+
+        if self.on_disconnect is not None:
+            self.on_disconnect()
+
+        try:
+            self.consumer.disconnect()
+        except Exception:
+            LOG.debug('Problem releasing the old connection.', exc_info=True)
+
+        delay = jittered_backoff(self._failed_attempts)
+        self._failed_attempts += 1
+        LOG.info('Reconnecting in {:.1f}s.'.format(delay))
+        time.sleep(delay)
+
+    def _drain_events(self):
+        connection = self.consumer.connection
+        while True:
+            try:
+                # Wake up often enough to send our heartbeats and run call_soon()'s functions
+                connection.drain_events(timeout=CALL_INTERVAL)
+            except socket.timeout:
+                pass
+            except (socket.error, IOError, OSError) as e:
+                # A signal handler ran while we were waiting; amqp keeps partial frames
+                if e.errno != errno.EINTR:
+                    raise
+            # Also after a message, so a steady flow of them does not starve the heartbeats.
+            # It raises if the broker has stopped sending heartbeats.
+            connection.heartbeat_check()
+            self._run_calls()
+
+    def call_soon(self, function, *args):
+        '''Have the consuming thread call function; it can be called from any thread.'''
+        self._calls.append((function, args))
+
+    def _run_calls(self):
+        while self._calls:
+            function, args = self._calls.popleft()
+            try:
+                function(*args)
+            except Exception:
+                # e.g. acknowledging a message of a connection which has dropped; Pulse
+                # delivers it again
+                LOG.warning('Failed to call %s from the consuming thread.', function.__name__,
+                            exc_info=True)
+
+    def keepalive(self):
+        '''Send a heartbeat while a callback keeps the consuming thread busy.
+
+        It has to be called from the consuming thread. The broker's heartbeats are not
+        read meanwhile; they are checked once we drain events again.
+        '''
+        self._run_calls()
+        now = time.time()
+        if self.heartbeat and now - self._last_keepalive >= self.heartbeat / 2.0:
+            self.consumer.connection.connection.send_heartbeat()
+            self._last_keepalive = now
+
+    def run_blocking(self, function, *args):
+        '''Call function in a helper thread and send heartbeats until it returns.'''
+        thread = threading.Thread(target=function, args=args, name='BlockingCallback')
+        thread.daemon = True
+        thread.start()
+        while thread.is_alive():
+            thread.join(self.heartbeat / 2.0 if self.heartbeat else None)
+            self.keepalive()
+
+    def run(self):
+        '''Consume messages forever. Only KeyboardInterrupt gets out of it.'''
+        while True:
+            try:
+                self._connect()
+                kombu_consumer = self.consumer._build_consumer()
+                self._connected(kombu_consumer)
+                with kombu_consumer:
+                    self._drain_events()
+            except KeyboardInterrupt:
+                raise
+            except ConsumerCancelled:
+                LOG.info('We have cleared the Pulse queue and need to restart')
+            except Exception:
+                LOG.exception('We have lost the connection to Pulse.')
+
+            self._disconnected()
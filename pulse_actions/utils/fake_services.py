@@ -0,0 +1,236 @@
+"""
+This module runs local stand-ins for the services the handlers talk to.
+
+Each fake service (Treeherder, TaskCluster, BuildAPI and S3) is an HTTP server on a
+local port which answers from recordings made with the replay runner's --record (see
+utils/recordings.py). Requests without a recording get a 404. Every service can be given:
+
+    - a latency distribution, e.g. "fixed:0.05", "exponential:0.1" (mean),
+      "lognormal:0.1:0.5" (median and sigma) or "uniform:0.01:0.2"
+    - an error rate; that fraction of the requests get a 503
+    - a rate limit in requests per second; requests over it get a 429
+
+redirect_to_fakes() sends every request made through requests for the hosts of a
+service to its fake instead. boto3 (used by TC_S3_Uploader) does not go through
+requests, so S3 uploads are only redirected for requests based callers.
+
+Requests are counted per endpoint, i.e. the method and the path with ids and revisions
+replaced by placeholders.
+
+A config looks like configs/fake_services.json:
+
+    {
+        "recordings": "recordings.json",
+        "services": {
+            "treeherder": {"hosts": ["treeherder.mozilla.org"], "latency": "lognormal:0.1:0.5",
+                           "error_rate": 0.01, "rate_limit": 20},
+            ...
+        }
+    }
+"""
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import Counter
+from SocketServer import ThreadingMixIn
+from urlparse import urlsplit, urlunsplit
+
+import requests
+
+from pulse_actions.utils import recordings
+
+LOG = logging.getLogger(__name__)
+ORIGINAL_HOST = 'X-Original-Host'
+ENDPOINT_PLACEHOLDERS = [
+    (re.compile(r'/[0-9a-f]{40}(?=/|$)'), '/{revision}'),
+    (re.compile(r'/[0-9a-f]{12}(?=/|$)'), '/{revision}'),
+    (re.compile(r'/\d+(?=/|$)'), '/{id}'),
+    # TaskCluster's slugids
+    (re.compile(r'/[A-Za-z0-9_-]{22}(?=/|$)'), '/{taskId}'),
+]
+LATENCIES = {
+    'fixed': lambda seconds: lambda: seconds,
+    'exponential': lambda mean: lambda: random.expovariate(1.0 / mean),
+    'lognormal': lambda median, sigma: lambda: random.lognormvariate(0, sigma) * median,
+    'uniform': lambda low, high: lambda: random.uniform(low, high),
+}
+
+
+def parse_latency(spec):
+    '''Return a function which samples the latency described by spec.'''
+    if not spec:
+        return lambda: 0
+
+    name, _, params = spec.partition(':')
+    if name not in LATENCIES:
+        raise ValueError('Unknown latency distribution {}'.format(name))
+    return LATENCIES[name](*[float(p) for p in params.split(':') if p])
+
+
+def endpoint(method, path):
+    for pattern, placeholder in ENDPOINT_PLACEHOLDERS:
+        path = pattern.sub(placeholder, path)
+    return '{} {}'.format(method, path)
+
+
+class _Throttle(object):
+    '''Token bucket; requests which find it empty are rejected.'''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeService(object):
+    def __init__(self, name, hosts, recorded=None, latency=None, error_rate=0,
+                 rate_limit=None):
+        self.name = name
+        self.hosts = hosts
+        self.recorded = recorded or {}
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.throttle = _Throttle(rate_limit) if rate_limit else None
+        self._lock = threading.Lock()
+        # Statistics
+        self.requests = Counter()
+        self.errors = 0
+        self.throttled = 0
+        self.misses = 0
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='FakeService-{}'.format(self.name))
+        thread.daemon = True
+        thread.start()
+        LOG.info('Fake {} listening on port {}.'.format(self.name, self.port))
+
+    def stop(self):
+        self.server.shutdown()
+
+    def respond(self, method, host, path, body):
+        '''Return the status, headers and content of a response.'''
+        with self._lock:
+            self.requests[endpoint(method, urlsplit(path).path)] += 1
+
+        if self.throttle is not None and not self.throttle.allow():
+            with self._lock:
+                self.throttled += 1
+            return 429, {'Retry-After': '1'}, ''
+
+        time.sleep(self.latency())
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            return 503, {}, ''
+
+        key = recordings.request_key(method, 'https://{}{}'.format(host, path), data=body)
+        recording = self.recorded.get(key)
+        if recording is None:
+            with self._lock:
+                self.misses += 1
+            return 404, {}, 'No recording for {}'.format(key)
+
+        response = recordings.build_response(key, recording)
+        headers = dict((k, v) for k, v in response.headers.items()
+                       if k.lower() not in ('content-length', 'content-encoding',
+                                            'transfer-encoding', 'connection'))
+        return response.status_code, headers, response.content
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else None
+                host = self.headers.get(ORIGINAL_HOST) or service.hosts[0]
+                status, headers, content = service.respond(self.command, host, self.path, body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _respond
+
+            def log_message(self, format, *args):
+                LOG.debug('%s: ' + format, service.name, *args)
+
+        return Handler
+
+    def report(self):
+        lines = ['Fake {}: {} requests, {} throttled, {} errors, {} without a recording'.format(
+            self.name, sum(self.requests.values()), self.throttled, self.errors, self.misses)]
+        for name, count in self.requests.most_common():
+            lines.append('  {:6} {}'.format(count, name))
+        return '\n'.join(lines)
+
+
+def start_fake_services(config_path):
+    '''Start the fake services of a config and return them by name.'''
+    with open(config_path) as file:
+        config = json.load(file)
+
+    recorded = recordings.load(config['recordings']) if config.get('recordings') else {}
+    services = {}
+    for name, service_config in config['services'].iteritems():
+        service = FakeService(
+            name=name,
+            hosts=service_config['hosts'],
+            recorded=recorded,
+            latency=service_config.get('latency'),
+            error_rate=service_config.get('error_rate', 0),
+            rate_limit=service_config.get('rate_limit'),
+        )
+        service.start()
+        services[name] = service
+    return services
+
+
+def redirect_to_fakes(services):
+    '''Send the requests made through requests for the hosts of a service to its fake.'''
+    ports = dict(
+        (host, service.port) for service in services.values() for host in service.hosts)
+    request = requests.sessions.Session.request
+
+    def redirected(session, method, url, **kwargs):
+        parts = urlsplit(url)
+        if parts.hostname in ports:
+            headers = dict(kwargs.pop('headers', None) or {})
+            headers[ORIGINAL_HOST] = parts.hostname
+            url = urlunsplit(('http', '127.0.0.1:{}'.format(ports[parts.hostname]),
+                              parts.path, parts.query, parts.fragment))
+            kwargs['headers'] = headers
+        return request(session, method, url, **kwargs)
+
+    requests.sessions.Session.request = redirected
+
+
+def total_requests(services):
+    return sum(sum(service.requests.values()) for service in services.values())
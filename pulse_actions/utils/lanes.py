@@ -0,0 +1,244 @@
+"""
+This module separates Pulse sources into priority lanes.
+
+Every lane consumes from its own Pulse queue and has its own concurrency budget.
+A shared pool of workers picks the next message with weighted round robin across
+the lanes which have pending messages, so a burst of automatic traffic cannot delay
+user requests. The time each message waited in its lane is reported per lane.
+
+A message is only acknowledged once a worker picks it up, so the messages still buffered
+in a lane when the worker stops (or its connection drops) are delivered again by Pulse.
+
+Lanes are configured in the worker config:
+
+    "sources": {
+        "manual_backfill": {"exchange": ..., "topic": ..., "lane": "user"},
+        "talos-jobs": {"exchange": ..., "topic": ..., "lane": "automatic"}
+    },
+    "lanes": {
+        "user": {"concurrency": 2, "weight": 3, "applabel": "pulse_actions"},
+        "automatic": {"concurrency": 1, "weight": 1}
+    }
+
+A lane's queue is named <applabel>-<lane> unless the lane has its own applabel. The user
+lane keeps the queue of the worker from before lanes existed, so its backlog is not
+abandoned; the bindings of the other lanes' sources are removed from it on start.
+"""
+import logging
+import threading
+
+from collections import deque
+from timeit import default_timer
+
+from replay.replay import PulseReplayConsumer
+
+from pulse_actions.utils.connection import HEARTBEAT, create_connection
+
+LOG = logging.getLogger(__name__)
+# Messages buffered (not acknowledged yet) per lane before the lane's consumer stops
+# draining its queue
+MAX_PENDING = 50
+
+
+class Lane(object):
+    def __init__(self, name, concurrency=1, weight=1, max_pending=MAX_PENDING, applabel=None):
+        self.name = name
+        self.applabel = applabel
+        self.concurrency = concurrency
+        self.weight = weight
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.running = 0
+        # Used by the smooth weighted round robin
+        self.current_weight = 0
+        # Queue wait statistics
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, wait):
+        self.processed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def report(self):
+        return 'Lane {}: {} messages, avg wait {:.2f}s, max wait {:.2f}s, {} pending'.format(
+            self.name,
+            self.processed,
+            self.total_wait / self.processed if self.processed else 0,
+            self.max_wait,
+            len(self.pending)
+        )
+
+
+class LaneScheduler(object):
+    '''Dispatch messages from all lanes into a shared pool of worker threads.'''
+    def __init__(self, lanes, process_message, workers, acknowledge=None):
+        '''
+        :param acknowledge: Called with the lane and the message when a worker picks it up
+        '''
+        self.lanes = lanes
+        self.process_message = process_message
+        self.workers = workers
+        self.acknowledge = acknowledge
+        self.stopped = False
+        self._cond = threading.Condition()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='LaneWorker-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+
+    def put(self, lane, data, message, keepalive=None):
+        '''Buffer a message; it blocks the caller while the lane is full.
+
+        :param keepalive: Called regularly while blocked, e.g. ConnectionManager.keepalive
+                          to keep sending the heartbeats of the lane's connection
+        '''
+        with self._cond:
+            while len(lane.pending) >= lane.max_pending and not self.stopped:
+                if keepalive is None:
+                    self._cond.wait()
+                else:
+                    self._cond.wait(HEARTBEAT / 2.0)
+                    keepalive()
+
+            lane.pending.append((default_timer(), data, message))
+            self._cond.notify_all()
+
+    def discard(self, lane):
+        '''Forget the messages buffered in a lane, e.g. after its connection dropped.'''
+        with self._cond:
+            discarded = len(lane.pending)
+            lane.pending.clear()
+            self._cond.notify_all()
+
+        if discarded:
+            LOG.info('Lane {}: {} unacknowledged messages will be delivered again.'.format(
+                lane.name, discarded))
+        return discarded
+
+    def stop(self):
+        '''Stop picking up messages and return how many are left in the lanes.
+
+        The messages being processed finish; the buffered ones were not acknowledged.
+        '''
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
+            return sum(len(lane.pending) for lane in self.lanes)
+
+    def update_lanes(self, lanes_config):
+        '''Apply new concurrency budgets and weights to the running lanes.'''
+        with self._cond:
+            for lane in self.lanes:
+                lane.concurrency = lanes_config[lane.name]['concurrency']
+                lane.weight = lanes_config[lane.name]['weight']
+            # A lane might be able to run more messages now
+            self._cond.notify_all()
+
+    def _next_lane(self):
+        '''Pick a lane with smooth weighted round robin. The caller holds the lock.'''
+        candidates = [
+            lane for lane in self.lanes if lane.pending and lane.running < lane.concurrency
+        ]
+        if not candidates or self.stopped:
+            return None
+
+        for lane in candidates:
+            lane.current_weight += lane.weight
+
+        chosen = max(candidates, key=lambda lane: lane.current_weight)
+        chosen.current_weight -= sum(lane.weight for lane in candidates)
+        return chosen
+
+    def _work(self):
+        while True:
+            with self._cond:
+                lane = self._next_lane()
+                while lane is None:
+                    if self.stopped:
+                        return
+                    self._cond.wait()
+                    lane = self._next_lane()
+
+                enqueued_at, data, message = lane.pending.popleft()
+                lane.running += 1
+                lane.record_wait(default_timer() - enqueued_at)
+                # A slot in the lane's buffer has been freed
+                self._cond.notify_all()
+
+            LOG.info(lane.report())
+            try:
+                if self.acknowledge is not None:
+                    self.acknowledge(lane, message)
+                self.process_message(data, message)
+            except Exception:
+                LOG.exception('Lane {} failed to process a message.'.format(lane.name))
+            finally:
+                with self._cond:
+                    lane.running -= 1
+                    self._cond.notify_all()
+
+
+def create_lanes(queue_config):
+    '''Return a Lane for each lane in the config after checking every source has one.'''
+    lanes_config = queue_config['lanes']
+    for name, source in queue_config['sources'].iteritems():
+        if source.get('lane') not in lanes_config:
+            raise ValueError('The source {} does not belong to any of the lanes {}'.format(
+                name, lanes_config.keys()))
+
+    return [
+        Lane(name=name, concurrency=lane['concurrency'], weight=lane['weight'],
+             applabel=lane.get('applabel'))
+        for name, lane in sorted(lanes_config.iteritems())
+    ]
+
+
+def lane_applabel(queue_config, lane):
+    return lane.applabel or '{}-{}'.format(queue_config['applabel'], lane.name)
+
+
+def create_lane_consumer(user, password, queue_config, lane, callback):
+    '''Create a Pulse consumer with its own queue for the sources of a lane.'''
+    sources = [s for s in queue_config['sources'].values() if s['lane'] == lane.name]
+
+    for source in sources:
+        LOG.info('Lane {} listening to ({}, {})'.format(
+            lane.name, source['exchange'], source['topic']))
+
+    return PulseReplayConsumer(
+        exchanges=[s['exchange'] for s in sources],
+        callback=callback,
+        # If the queue exists and is durable it should match
+        durable=queue_config['durable'] in ('true', 'True'),
+        password=password,
+        topic=[s['topic'] for s in sources],
+        user=user,
+        applabel=lane_applabel(queue_config, lane),
+    )
+
+
+def unbind_other_lanes(consumer, queue_config, lane):
+    '''Remove the bindings of other lanes' sources from a lane's queue.
+
+    They are left over on a queue which was consumed for every source before the
+    lanes existed.
+    '''
+    own = set((s['exchange'], s['topic'])
+              for s in queue_config['sources'].values() if s['lane'] == lane.name)
+    others = set((s['exchange'], s['topic'])
+                 for s in queue_config['sources'].values()) - own
+
+    connection = create_connection(consumer.config)
+    try:
+        channel = connection.channel()
+        for exchange, topic in sorted(others):
+            # Unbinding a binding which does not exist is a no-op for RabbitMQ
+            channel.queue_unbind(queue=consumer.queue_name, exchange=exchange, routing_key=topic)
+            LOG.info('{}: unbound from ({}, {}) of another lane'.format(
+                consumer.queue_name, exchange, topic))
+    finally:
+        connection.release()
@@ -0,0 +1,191 @@
+"""
+This module keeps workers sharing a Pulse queue from acting on the same push at once.
+
+Before a user request is processed the worker claims a lease keyed by
+(repo, revision, action) and, for job actions, the job. If another worker holds it we
+either skip the request (when a second one would only repeat the same work, e.g.
+trigger_missing_jobs) or raise LeaseHeld. The worker then defers the request in the
+retry store instead of keeping a lane worker waiting.
+
+Leases expire after a TTL so a worker which dies does not block a push forever. The
+holder renews its lease from a background thread while the request runs.
+
+Backends implement LeaseBackend:
+    - SQLiteLeaseBackend for workers on a single host (or sharing a file system)
+    - RedisLeaseBackend for workers on different hosts (it needs the redis package)
+"""
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+from pulse_actions.utils.retry_store import RetryLater
+from pulse_actions.utils.startup import timed_import
+
+LOG = logging.getLogger(__name__)
+# Seconds after which a lease is considered abandoned; it is renewed every third of it
+LEASE_TTL = 30 * 60
+# Seconds before a request whose lease is held by another worker is processed again
+LEASE_WAIT = 60
+# Actions for which a concurrent request for the same push is a duplicate
+DEDUPLICATED_ACTIONS = (
+    'trigger_missing_jobs',
+)
+
+
+class LeaseHeld(RetryLater):
+    pass
+
+
+class LeaseBackend(object):
+    '''Interface of the lease backends.
+
+    claim() has to be atomic across every worker using the backend.
+    '''
+    def claim(self, key, owner, ttl):
+        '''Return True if owner now holds key for ttl seconds.'''
+        raise NotImplementedError
+
+    def renew(self, key, owner, ttl):
+        '''Extend key by ttl seconds from now; return False if owner lost it.'''
+        raise NotImplementedError
+
+    def release(self, key, owner):
+        '''Release key if owner still holds it.'''
+        raise NotImplementedError
+
+
+class SQLiteLeaseBackend(LeaseBackend):
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Other processes might hold the database's lock for a moment
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS leases ('
+                'key TEXT PRIMARY KEY, '
+                'owner TEXT NOT NULL, '
+                'expires REAL NOT NULL)'
+            )
+
+    def claim(self, key, owner, ttl):
+        now = time.time()
+        # The DELETE starts a transaction which locks out other processes until we commit
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM leases WHERE key = ? AND expires <= ?', (key, now))
+            self._conn.execute(
+                'INSERT OR IGNORE INTO leases (key, owner, expires) VALUES (?, ?, ?)',
+                (key, owner, now + ttl)
+            )
+            row = self._conn.execute('SELECT owner FROM leases WHERE key = ?', (key,)).fetchone()
+
+        return row[0] == owner
+
+    def renew(self, key, owner, ttl):
+        with self._lock, self._conn:
+            return self._conn.execute(
+                'UPDATE leases SET expires = ? WHERE key = ? AND owner = ?',
+                (time.time() + ttl, key, owner)
+            ).rowcount == 1
+
+    def release(self, key, owner):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, owner))
+
+
+class RedisLeaseBackend(LeaseBackend):
+    # Only touch the key if we still own it
+    RENEW_SCRIPT = '''
+        if redis.call("get", KEYS[1]) == ARGV[1] then
+            return redis.call("expire", KEYS[1], ARGV[2])
+        end
+        return 0
+    '''
+    RELEASE_SCRIPT = '''
+        if redis.call("get", KEYS[1]) == ARGV[1] then
+            return redis.call("del", KEYS[1])
+        end
+        return 0
+    '''
+
+    def __init__(self, url, prefix='pulse_actions:lease:'):
+        self.prefix = prefix
+        self._client = timed_import('redis').StrictRedis.from_url(url)
+        self._renew = self._client.register_script(self.RENEW_SCRIPT)
+        self._release = self._client.register_script(self.RELEASE_SCRIPT)
+
+    def claim(self, key, owner, ttl):
+        return bool(self._client.set(self.prefix + key, owner, nx=True, ex=int(ttl)))
+
+    def renew(self, key, owner, ttl):
+        return bool(self._renew(keys=[self.prefix + key], args=[owner, int(ttl)]))
+
+    def release(self, key, owner):
+        self._release(keys=[self.prefix + key], args=[owner])
+
+
+def create_backend(url):
+    '''Return the backend for a redis:// URL or the path of a SQLite file.'''
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisLeaseBackend(url)
+    return SQLiteLeaseBackend(url)
+
+
+class Lease(object):
+    def __init__(self, backend, key, ttl):
+        self.backend = backend
+        self.key = key
+        self.ttl = ttl
+        self.owner = uuid.uuid4().hex
+        self._released = threading.Event()
+
+    def keep_renewing(self):
+        '''Renew the lease from a background thread until it is released.'''
+        thread = threading.Thread(target=self._renew, name='LeaseRenewer')
+        thread.daemon = True
+        thread.start()
+
+    def _renew(self):
+        while not self._released.wait(self.ttl / 3.0):
+            try:
+                if not self.backend.renew(self.key, self.owner, self.ttl):
+                    LOG.warning('We have lost the lease {}.'.format(self.key))
+                    return
+            except Exception:
+                # We try again before it expires
+                LOG.exception('Failed to renew the lease {}.'.format(self.key))
+
+    def release(self):
+        self._released.set()
+        try:
+            self.backend.release(self.key, self.owner)
+        except Exception:
+            # It will expire
+            LOG.exception('Failed to release the lease {}.'.format(self.key))
+
+
+class LeaseService(object):
+    def __init__(self, backend, ttl=LEASE_TTL, wait=LEASE_WAIT):
+        self.backend = backend
+        self.ttl = ttl
+        self.wait = wait
+
+    def claim(self, repo_name, revision, action, job_id=None):
+        '''Return a Lease, or None if the request duplicates one in progress.
+
+        It raises LeaseHeld if another worker is acting on the same push (or job).
+        '''
+        parts = [repo_name, revision, action] + ([job_id] if job_id is not None else [])
+        lease = Lease(self.backend, ':'.join(map(str, parts)), self.ttl)
+        if self.backend.claim(lease.key, lease.owner, self.ttl):
+            lease.keep_renewing()
+            return lease
+
+        if action in DEDUPLICATED_ACTIONS:
+            LOG.info('Another worker is already running {}; skipping this request.'.format(
+                lease.key))
+            return None
+
+        raise LeaseHeld('Another worker is running {}'.format(lease.key), delay=self.wait)
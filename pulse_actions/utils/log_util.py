@@ -1,6 +1,13 @@
+import atexit
+import copy
+import json
 import logging
 import os
+import threading
+import time
 
+from contextlib import contextmanager
+from Queue import Queue
 from tempfile import gettempdir
 from uuid import uuid4
 
@@ -10,6 +17,143 @@ FORMATTER = logging.Formatter(
     datefmt='%H:%M:%S'
 )
 ALL_HANDLERS = {}
+LISTENER = None
+# Attributes every LogRecord has; anything else was passed with extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None)).keys())
+# The requests the current thread logs on behalf of
+_CONTEXT = threading.local()
+
+
+def request_ids():
+    '''Return the ids of the requests the current thread is working for.'''
+    return getattr(_CONTEXT, 'ids', ())
+
+
+@contextmanager
+def working_for(ids):
+    '''Log on behalf of requests, e.g. from a helper thread; see request_ids().'''
+    previous = request_ids()
+    _CONTEXT.ids = tuple(ids)
+    try:
+        yield
+    finally:
+        _CONTEXT.ids = previous
+
+
+class RequestFilter(logging.Filter):
+    '''Only let through records logged on behalf of a request.
+
+    Requests can be processed concurrently and each one has its own log file. Helper
+    threads (e.g. trigger_executor's) log on behalf of requests with working_for().
+    '''
+    def __init__(self, request_id):
+        logging.Filter.__init__(self)
+        self.request_id = request_id
+
+    def filter(self, record):
+        # Filters run in the thread which logs the record
+        return self.request_id in request_ids()
+
+
+class JsonFormatter(logging.Formatter):
+    '''Format records as one JSON object per line.'''
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).iteritems():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        # QueueHandler only leaves the text of the exception
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=repr)
+
+
+class QueueHandler(logging.Handler):
+    '''Hand records over to a QueueListener.
+
+    The console's formatting and writing happen in the listener's thread instead of the
+    thread processing the message.
+    '''
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        '''Merge the message with its arguments like logging.handlers.QueueHandler.
+
+        The arguments (e.g. a Pulse message) could change before the listener gets to the
+        record, and a traceback can only be formatted while it is being handled.
+        '''
+        # It sets record.message and fills in exc_text
+        self.format(record)
+        record = copy.copy(record)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(threading.Thread):
+    '''Background thread which passes queued records to the real handlers.'''
+    _STOP = None
+
+    def __init__(self, queue, *handlers):
+        super(QueueListener, self).__init__(name='QueueListener')
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._STOP:
+                break
+
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        self.queue.put(self._STOP)
+        self.join()
+
+
+class Sampler(object):
+    '''Only let through one call per key every interval seconds.
+
+    It is used for log lines of high volume messages (e.g. ignored build messages).
+    '''
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        # key -> [time it was last let through, calls skipped since then]
+        self._keys = {}
+
+    def sample(self, key):
+        '''Return (should the caller log, how many calls were skipped before this one).'''
+        now = time.time()
+        with self._lock:
+            last, skipped = self._keys.get(key, (0, 0))
+            if now - last < self.interval:
+                self._keys[key] = (last, skipped + 1)
+                return False, skipped + 1
+
+            self._keys[key] = (now, 0)
+            return True, skipped
 
 
 def start_logging(log_level=logging.INFO):
@@ -21,6 +165,9 @@ def start_logging(log_level=logging.INFO):
     # Developers only care about the messages (no asctime or level names)
     # The name of the modules are left in case they want to debug pulse_actions
     file_handler.setFormatter(logging.Formatter('%(name)s %(message)s'))
+    # The log path identifies the request
+    file_handler.addFilter(RequestFilter(log_path))
+    _CONTEXT.ids = request_ids() + (log_path,)
 
     LOG.addHandler(file_handler)
     LOG.info("This log was produced by https://github.com/mozilla/pulse_actions "
@@ -32,11 +179,14 @@ def start_logging(log_level=logging.INFO):
 def end_logging(log_path):
     global ALL_HANDLERS
 
-    LOG.removeHandler(ALL_HANDLERS[log_path])
+    file_handler = ALL_HANDLERS.pop(log_path)
+    LOG.removeHandler(file_handler)
+    file_handler.close()
+    _CONTEXT.ids = tuple(i for i in request_ids() if i != log_path)
 
 
-def setup_logging(logging_level):
-    global LOG
+def setup_logging(logging_level, json_format=False):
+    global LOG, LISTENER
     if LOG:
         return LOG
 
@@ -48,11 +198,24 @@ def setup_logging(logging_level):
     # Handler - Output to console (this is the output for Papertrail)
     console = logging.StreamHandler()
     console.setLevel(logging_level)
-    # No need to track asctime as Papertrail logs times
-    # Keep levelname for error() messages to alert
-    formatter = logging.Formatter('%(name)s\t %(levelname)s:\t %(message)s')
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        # No need to track asctime as Papertrail logs times
+        # Keep levelname for error() messages to alert
+        formatter = logging.Formatter('%(name)s\t %(levelname)s:\t %(message)s')
     console.setFormatter(formatter)
-    LOG.addHandler(console)
+
+    # The console output is written from a background thread so it does not
+    # add to the time it takes to process a message
+    queue = Queue()
+    queue_handler = QueueHandler(queue)
+    queue_handler.setLevel(logging_level)
+    LOG.addHandler(queue_handler)
+    LISTENER = QueueListener(queue, console)
+    LISTENER.start()
+    # Flush what is left in the queue
+    atexit.register(LISTENER.stop)
 
     LOG.info("Console output logs %s level messages." % logging.getLevelName(logging_level))
 
@@ -0,0 +1,110 @@
+"""
+This module keeps the worker within a memory budget.
+
+After every message MemoryBudget checks the resident set size (RSS). Once it goes
+over a fraction of the budget the registered caches are shed so we never get near
+the dyno's limit. CPython rarely gives freed memory back to the OS, so the RSS can stay
+high after shedding; we only shed again after a cooldown or once the RSS has grown
+noticeably since the last time, instead of emptying the caches after every message.
+
+With trace_allocations (it slows down every allocation) and tracemalloc available
+(pytracemalloc on Python 2) the top allocations are reported periodically.
+"""
+import gc
+import logging
+import os
+import resource
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+LOG = logging.getLogger(__name__)
+# Shed caches once the RSS goes over this fraction of the budget
+SHED_RATIO = 0.8
+# Seconds before we shed again unless the RSS grew by this fraction of the budget
+SHED_COOLDOWN = 5 * 60
+SHED_GROWTH_RATIO = 0.05
+# Report the top allocations every this many messages
+REPORT_EVERY = 100
+TOP_ALLOCATIONS = 10
+
+
+def rss_mb():
+    '''Return the current resident set size in MB.'''
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024)
+    except (IOError, OSError):
+        # Not Linux; use the peak RSS which is in KB
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class MemoryBudget(object):
+    def __init__(self, limit_mb, shed_ratio=SHED_RATIO, report_every=REPORT_EVERY,
+                 cooldown=SHED_COOLDOWN, trace_allocations=False):
+        self.limit_mb = limit_mb
+        self.shed_ratio = shed_ratio
+        self.report_every = report_every
+        self.cooldown = cooldown
+        self.caches = {}
+        self.messages = 0
+        self._lock = threading.Lock()
+        # When we last shed and the RSS right after it
+        self._shed_at = None
+        self._rss_after_shed = None
+
+        self.tracing = trace_allocations and tracemalloc is not None
+        if trace_allocations and tracemalloc is None:
+            LOG.warning('We cannot trace allocations without tracemalloc.')
+        if self.tracing and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def register_cache(self, name, clear):
+        '''Register a function which empties a cache we can live without.'''
+        self.caches[name] = clear
+
+    def shed(self):
+        for name, clear in sorted(self.caches.iteritems()):
+            LOG.info('Shedding {}.'.format(name))
+            clear()
+        gc.collect()
+
+    def _should_shed(self, rss):
+        if rss <= self.limit_mb * self.shed_ratio:
+            return False
+        if self._shed_at is None:
+            return True
+        # Shedding again right away would only make us rebuild the caches
+        return (time.time() - self._shed_at >= self.cooldown or
+                rss - self._rss_after_shed >= self.limit_mb * SHED_GROWTH_RATIO)
+
+    def check(self):
+        '''Shed caches if we are close to the budget. Call it between messages.'''
+        with self._lock:
+            self.messages += 1
+            rss = rss_mb()
+            if self._should_shed(rss):
+                LOG.warning('RSS {:.0f}MB is close to the memory budget of {}MB.'.format(
+                    rss, self.limit_mb))
+                self.shed()
+                self._shed_at = time.time()
+                self._rss_after_shed = rss_mb()
+                LOG.info('RSS after shedding caches: {:.0f}MB'.format(self._rss_after_shed))
+
+            if self.messages % self.report_every == 0:
+                self.report()
+
+    def report(self):
+        LOG.info('RSS {:.0f}MB out of a memory budget of {}MB.'.format(rss_mb(), self.limit_mb))
+        if not self.tracing:
+            return
+
+        stats = tracemalloc.take_snapshot().statistics('lineno')
+        LOG.info('Top {} allocations:'.format(TOP_ALLOCATIONS))
+        for stat in stats[:TOP_ALLOCATIONS]:
+            LOG.info('- {}'.format(stat))
@@ -4,6 +4,9 @@ This module helps with functionality which is common to all handlers.
 import logging
 
 from mozci.mozci import valid_builder
+from thclient import TreeherderClient
+
+from pulse_actions.utils import throttling
 
 LOG = logging.getLogger(__name__)
 TREEHERDER = '%(treeherder_server_url)s/#/jobs?repo=%(repo)s&revision=%(revision)s'
@@ -13,6 +16,13 @@ BUILDERNAME_REPLACEMENTS = [
 ]
 
 
+def create_treeherder_client(server_url):
+    '''Return a TreeherderClient whose requests go through our throttling.'''
+    client = TreeherderClient(server_url=server_url)
+    throttling.install(client.session)
+    return client
+
+
 def whitelisted_users(requester):
     return requester in (
         'aleth@instantbird.org',
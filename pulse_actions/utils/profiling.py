@@ -0,0 +1,141 @@
+"""
+This module profiles slow messages.
+
+When profiling is on (--profile or toggled at runtime with SIGUSR2) a sampling profiler
+records the stacks of the thread routing each message. We only keep the profiles of
+the slowest messages (and of those over a threshold) as "folded" stacks which can be
+fed to flamegraph.pl or speedscope. Files are named after the seconds it took, the
+exchange, the handler and the message id, followed by our pid and a sequence number so
+two profiles (e.g. of a retried message) never share a file.
+
+When profiling is off the only cost is checking a flag.
+"""
+import heapq
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+
+from collections import Counter
+from contextlib import contextmanager
+from tempfile import gettempdir
+from timeit import default_timer
+
+from pulse_actions.utils.schemas import message_exchange
+from pulse_actions.utils.shadow import message_id
+
+LOG = logging.getLogger(__name__)
+DEFAULT_DIR = os.path.join(gettempdir(), 'pulse_actions_profiles')
+# Seconds between samples
+SAMPLING_INTERVAL = 0.005
+KEEP_SLOWEST = 20
+
+
+class StackSampler(threading.Thread):
+    '''Sample the stack of another thread and count the folded stacks.'''
+    def __init__(self, thread_id, interval=SAMPLING_INTERVAL):
+        super(StackSampler, self).__init__(name='StackSampler')
+        self.daemon = True
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class Profiler(object):
+    def __init__(self, handler_name, output_dir=DEFAULT_DIR, keep=KEEP_SLOWEST, threshold=None):
+        '''
+        :param handler_name: Function returning the name of the handler for a message and
+                             its kombu message
+        :param keep: How many of the slowest profiles to keep
+        :param threshold: Seconds over which profiles are always kept
+        '''
+        self.enabled = False
+        self.handler_name = handler_name
+        self.output_dir = output_dir
+        self.keep = keep
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        # Min heap of (seconds, path) with the slowest profiles
+        self._slowest = []
+        # Profiles written so far
+        self._saved = 0
+
+    def toggle(self, *args):
+        '''Signal handler to turn profiling on and off.'''
+        self.enabled = not self.enabled
+        LOG.info('Profiling is {}; profiles are written to {}'.format(
+            'on' if self.enabled else 'off', self.output_dir))
+
+    def install_signal_handler(self, signum=signal.SIGUSR2):
+        # It can only be called from the main thread
+        signal.signal(signum, self.toggle)
+        # Restart the system calls it interrupts, e.g. reading from the Pulse connection
+        signal.siginterrupt(signum, False)
+
+    @contextmanager
+    def profile(self, data, message):
+        if not self.enabled:
+            yield
+            return
+
+        sampler = StackSampler(threading.current_thread().ident)
+        sampler.start()
+        start = default_timer()
+        try:
+            yield
+        finally:
+            seconds = default_timer() - start
+            sampler.stop()
+            self._save(data, message, seconds, sampler.stacks)
+
+    def _save(self, data, message, seconds, stacks):
+        with self._lock:
+            over_threshold = self.threshold is not None and seconds >= self.threshold
+            among_slowest = len(self._slowest) < self.keep or seconds > self._slowest[0][0]
+            if not (over_threshold or among_slowest):
+                return
+
+            self._saved += 1
+            name = '{:.2f}s-{}-{}-{}-{}-{}.folded'.format(
+                seconds,
+                message_exchange(data, message) or 'unknown',
+                self.handler_name(data, message),
+                message_id(data),
+                os.getpid(),
+                self._saved)
+            path = os.path.join(self.output_dir, re.sub(r'[^\w.-]', '_', name))
+            if not os.path.isdir(self.output_dir):
+                os.makedirs(self.output_dir)
+
+            with open(path, 'w') as file:
+                for stack, count in stacks.most_common():
+                    file.write('{} {}\n'.format(stack, count))
+
+            if over_threshold:
+                # It is not subject to being replaced by slower ones
+                return
+
+            heapq.heappush(self._slowest, (seconds, path))
+            if len(self._slowest) > self.keep:
+                _, evicted = heapq.heappop(self._slowest)
+                os.remove(evicted)
@@ -0,0 +1,341 @@
+"""
+This module keeps a local index of pushes and jobs so handlers can skip REST queries.
+
+For each push we know of we keep its revision, its author, its decision task and up to
+max_jobs_per_push of its jobs (as JobRecords) which can be looked up by id or type. The
+decision task is always kept since finding it again takes the most queries. Only the
+most recently used pushes are kept.
+
+The index is filled in two ways:
+    - Whatever handlers fetch from Treeherder when the index misses is added to it;
+      we only keep fields which do not change once a job exists (not e.g. its state)
+    - With --push-index the worker subscribes to the sources of the "index" section of
+      its config (new pushes, jobs and TaskCluster task definitions) and feeds the index
+      as events arrive
+
+The lookup_* functions answer from the index first and fall back to Treeherder.
+"""
+import logging
+import threading
+
+from collections import OrderedDict
+
+from replay.replay import PulseReplayConsumer
+
+from pulse_actions.utils.log_util import Sampler
+from pulse_actions.utils.records import JobRecord
+
+LOG = logging.getLogger(__name__)
+MAX_PUSHES = 500
+# Pushes can have thousands of jobs; handlers look up a few of them
+MAX_JOBS_PER_PUSH = 200
+DECISION_TASK = 'Gecko Decision Task'
+JOBS_PER_CALL = 250
+TREEHERDER_ROUTE = ['tc-treeherder', 'v2']
+# Log at most one failure to index an event every minute
+FAILURE_SAMPLER = Sampler(interval=60)
+
+
+class _Push(object):
+    __slots__ = ('revision', 'author', 'decision_task_id', 'jobs')
+
+    def __init__(self, revision=None):
+        self.revision = revision
+        self.author = None
+        self.decision_task_id = None
+        # Job id -> JobRecord; the least recently added first
+        self.jobs = OrderedDict()
+
+
+class PushIndex(object):
+    def __init__(self, max_pushes=MAX_PUSHES, max_jobs_per_push=MAX_JOBS_PER_PUSH):
+        self.max_pushes = max_pushes
+        self.max_jobs_per_push = max_jobs_per_push
+        self._lock = threading.Lock()
+        # (repo, push id) -> _Push; the least recently used first
+        self._pushes = OrderedDict()
+        # (repo, revision) -> push id
+        self._push_ids = {}
+        # (repo, job id) -> push id
+        self._job_pushes = {}
+        # Decision tasks of pushes we do not know yet; (repo, revision) -> task id
+        self._pending_decisions = OrderedDict()
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        # Pulse events we could not index
+        self.failures = 0
+
+    def _push(self, repo_name, push_id, create=False):
+        '''Return a push and mark it as recently used. The caller holds the lock.'''
+        # Pulse messages can have ids as strings
+        key = (repo_name, int(push_id))
+        push = self._pushes.pop(key, None)
+        if push is None:
+            if not create:
+                return None
+            push = _Push()
+
+        self._pushes[key] = push
+        while len(self._pushes) > self.max_pushes:
+            self._evict()
+        return push
+
+    def _evict(self):
+        (repo_name, push_id), push = self._pushes.popitem(last=False)
+        self._push_ids.pop((repo_name, push.revision), None)
+        for job_id in push.jobs:
+            self._job_pushes.pop((repo_name, job_id), None)
+
+    def _record(self, value):
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def add_push(self, repo_name, push_id, revision, author=None):
+        with self._lock:
+            push = self._push(repo_name, push_id, create=True)
+            push.revision = revision
+            if author is not None:
+                push.author = author
+            self._push_ids[(repo_name, revision)] = int(push_id)
+            decision_task_id = self._pending_decisions.pop((repo_name, revision), None)
+            if decision_task_id is not None:
+                push.decision_task_id = decision_task_id
+
+    def add_job(self, repo_name, job):
+        '''Add a JobRecord.'''
+        with self._lock:
+            push = self._push(repo_name, job.result_set_id, create=True)
+            push.jobs.pop(int(job.id), None)
+            push.jobs[int(job.id)] = job
+            self._job_pushes[(repo_name, int(job.id))] = int(job.result_set_id)
+            if len(push.jobs) > self.max_jobs_per_push:
+                self._evict_job(repo_name, push)
+
+    def _evict_job(self, repo_name, push):
+        '''Drop the oldest job of a push other than its decision task.'''
+        for job_id, job in push.jobs.iteritems():
+            if job.job_type_name != DECISION_TASK:
+                del push.jobs[job_id]
+                self._job_pushes.pop((repo_name, job_id), None)
+                return
+
+    def set_decision_task(self, repo_name, revision, task_id):
+        with self._lock:
+            push_id = self._push_ids.get((repo_name, revision))
+            if push_id is not None:
+                self._push(repo_name, push_id).decision_task_id = task_id
+                return
+
+            self._pending_decisions[(repo_name, revision)] = task_id
+            while len(self._pending_decisions) > self.max_pushes:
+                self._pending_decisions.popitem(last=False)
+
+    def set_push_decision_task(self, repo_name, push_id, task_id):
+        with self._lock:
+            self._push(repo_name, push_id, create=True).decision_task_id = task_id
+
+    def revision(self, repo_name, push_id):
+        with self._lock:
+            push = self._push(repo_name, push_id)
+            return self._record(push.revision if push else None)
+
+    def author(self, repo_name, push_id):
+        with self._lock:
+            push = self._push(repo_name, push_id)
+            return self._record(push.author if push else None)
+
+    def decision_task_id(self, repo_name, push_id):
+        with self._lock:
+            push = self._push(repo_name, push_id)
+            return self._record(push.decision_task_id if push else None)
+
+    def job(self, repo_name, job_id):
+        with self._lock:
+            push_id = self._job_pushes.get((repo_name, int(job_id)))
+            push = self._push(repo_name, push_id) if push_id is not None else None
+            return self._record(push.jobs.get(int(job_id)) if push else None)
+
+    def jobs(self, repo_name, push_id, job_type_name=None):
+        '''Return the jobs we know of for a push, optionally by type.'''
+        with self._lock:
+            push = self._push(repo_name, push_id)
+            if push is None:
+                return []
+            return [
+                job for job in push.jobs.values()
+                if job_type_name is None or job.job_type_name == job_type_name
+            ]
+
+    def clear(self):
+        with self._lock:
+            self._pushes.clear()
+            self._push_ids.clear()
+            self._job_pushes.clear()
+            self._pending_decisions.clear()
+
+    def report(self):
+        return 'Push index: {} pushes, {} jobs, {} hits, {} misses, {} events failed'.format(
+            len(self._pushes), len(self._job_pushes), self.hits, self.misses, self.failures)
+
+
+INDEX = PushIndex()
+
+
+def lookup_job(treeherder_client, repo_name, job_id):
+    '''Return the JobRecord of a job or None if Treeherder does not know it either.'''
+    job = INDEX.job(repo_name, job_id)
+    if job is None:
+        results = treeherder_client.get_jobs(repo_name, id=job_id)
+        if not results:
+            return None
+        job = JobRecord.from_treeherder(results[0])
+        INDEX.add_job(repo_name, job)
+    return job
+
+
+def _fetch_push(treeherder_client, repo_name, push_id):
+    resultset = treeherder_client.get_resultsets(repo_name, id=push_id)[0]
+    INDEX.add_push(repo_name, push_id, resultset['revision'], author=resultset['author'])
+    return resultset
+
+
+def lookup_revision(treeherder_client, repo_name, push_id):
+    revision = INDEX.revision(repo_name, push_id)
+    if revision is None:
+        revision = _fetch_push(treeherder_client, repo_name, push_id)['revision']
+    return revision
+
+
+def lookup_author(treeherder_client, repo_name, push_id):
+    author = INDEX.author(repo_name, push_id)
+    if author is None:
+        author = _fetch_push(treeherder_client, repo_name, push_id)['author']
+    return author
+
+
+def lookup_decision_task_id(treeherder_client, repo_name, push_id):
+    '''Return the task id of a push's decision task.'''
+    decision_task_id = INDEX.decision_task_id(repo_name, push_id)
+    if decision_task_id is not None:
+        return decision_task_id
+
+    decisions = INDEX.jobs(repo_name, push_id, job_type_name=DECISION_TASK)
+    decision = decisions[0] if decisions else None
+
+    # We only hold on to the decision task instead of every job of the push
+    offset = 0
+    while decision is None:
+        results = treeherder_client.get_jobs(
+            repo_name,
+            push_id=push_id,
+            count=JOBS_PER_CALL,
+            offset=offset
+        )
+        for job in results:
+            if job['job_type_name'] == DECISION_TASK:
+                decision = JobRecord.from_treeherder(job)
+                INDEX.add_job(repo_name, decision)
+                break
+
+        if len(results) < JOBS_PER_CALL:
+            break
+        offset += JOBS_PER_CALL
+
+    if decision is None:
+        raise IndexError('We could not find the decision task for push {}'.format(push_id))
+
+    details = treeherder_client.get_job_details(job_guid=decision.job_guid)
+    inspect = [detail['url'] for detail in details if detail['value'] == 'Inspect Task'][0]
+    # Pull out the taskId from the URL e.g.
+    # oN1NErz_Rf2DZJ1hi7YVfA from <tc_tools_site>/task-inspector/#oN1NErz_Rf2DZJ1hi7YVfA/
+    decision_task_id = inspect.partition('#')[-1].rpartition('/')[0]
+    INDEX.set_push_decision_task(repo_name, push_id, decision_task_id)
+    return decision_task_id
+
+
+def index_push(data, message):
+    '''Treeherder's new push events.'''
+    push_id = data.get('resultset_id', data.get('push_id'))
+    INDEX.add_push(data['project'], push_id, data['revision'], author=data.get('author'))
+
+
+def index_job(data, message):
+    '''Treeherder's job events; they have the fields of the REST API plus the project.'''
+    INDEX.add_job(data['project'], JobRecord.from_treeherder(data))
+
+
+def _task_routes(data, message):
+    '''Return the routes of a task event without their "route." prefix.
+
+    The routing key of the delivery is the task's primary one; its routes are in the
+    task definition (newer events) and in the CC header the queue publishes them with.
+    '''
+    routes = list(data.get('task', {}).get('routes', []))
+    headers = getattr(message, 'headers', None) or {}
+    routes.extend(route[len('route.'):] for route in headers.get('CC', [])
+                  if route.startswith('route.'))
+    return routes
+
+
+def index_task(data, message):
+    '''TaskCluster's task events for tasks with a tc-treeherder route.
+
+    A decision task is the task its task group is named after.
+    '''
+    status = data['status']
+    if status['taskId'] != status['taskGroupId']:
+        return
+
+    # tc-treeherder.v2.<project>.<revision>.<pushlog id>
+    for route in _task_routes(data, message):
+        parts = route.split('.')
+        if parts[:2] == TREEHERDER_ROUTE and len(parts) >= 4:
+            INDEX.set_decision_task(parts[2], parts[3], status['taskId'])
+            return
+
+
+INDEXERS = {
+    'push': index_push,
+    'job': index_job,
+    'task': index_task,
+}
+
+
+def create_index_consumer(user, password, index_config):
+    '''Create a Pulse consumer which feeds INDEX from the sources of index_config.'''
+    sources = index_config['sources'].values()
+    indexers = dict((source['exchange'], INDEXERS[source['kind']]) for source in sources)
+
+    for source in sources:
+        LOG.info('Indexing {} events from ({}, {})'.format(
+            source['kind'], source['exchange'], source['topic']))
+
+    def callback(data, message):
+        try:
+            indexers[message.delivery_info['exchange']](data, message)
+        except Exception:
+            INDEX.failures += 1
+            log_it, skipped = FAILURE_SAMPLER.sample('index')
+            if log_it:
+                LOG.warning('Failed to index %.200s (%d other failures were not logged)',
+                            data, skipped, exc_info=True)
+        finally:
+            # Missing an event only means the handlers will ask Treeherder
+            message.ack()
+
+    INDEX.max_pushes = index_config.get('max_pushes', MAX_PUSHES)
+    INDEX.max_jobs_per_push = index_config.get('max_jobs_per_push', MAX_JOBS_PER_PUSH)
+    return PulseReplayConsumer(
+        exchanges=[s['exchange'] for s in sources],
+        callback=callback,
+        # The index is rebuilt on every start
+        durable=False,
+        password=password,
+        topic=[s['topic'] for s in sources],
+        user=user,
+        applabel=index_config['applabel'],
+    )
@@ -0,0 +1,113 @@
+"""
+This module records the HTTP responses the handlers get and plays them back.
+
+Every library we use to talk to Treeherder, TaskCluster, BuildAPI and the rest goes
+through requests' Session.request, so that is what we replace. Responses are keyed by
+the method, the full URL (with its query string) and a hash of the body.
+
+Recordings are JSON lines:
+
+    {"key": ..., "status": 200, "headers": {...}, "content": <base64>}
+
+When playing back, a request without a recording fails with a ConnectionError so the
+outcome of a message does not depend on which services are reachable.
+"""
+import base64
+import hashlib
+import json
+import logging
+import threading
+
+import requests
+
+from requests.structures import CaseInsensitiveDict
+
+LOG = logging.getLogger(__name__)
+_ORIGINAL_REQUEST = requests.sessions.Session.request
+
+
+def request_key(method, url, params=None, data=None, json_body=None):
+    '''Return the key of a request in the recordings.'''
+    # The same URL and body requests would send
+    request = requests.Request(method, url, params=params, data=data, json=json_body).prepare()
+    body = request.body
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+
+    body_hash = hashlib.sha1(body).hexdigest()[:16] if body else ''
+    return '{} {} {}'.format(method.upper(), request.url, body_hash).strip()
+
+
+def build_response(url, recording):
+    response = requests.models.Response()
+    response.status_code = recording['status']
+    response.headers = CaseInsensitiveDict(recording['headers'])
+    response.url = url
+    response.encoding = 'utf-8'
+    response._content = base64.b64decode(recording['content'])
+    response._content_consumed = True
+    return response
+
+
+def load(path):
+    '''Return the recordings in a file keyed by request.'''
+    recordings = {}
+    with open(path) as file:
+        for line in file:
+            recording = json.loads(line)
+            recordings[recording['key']] = recording
+    return recordings
+
+
+def save(path, recordings):
+    with open(path, 'w') as file:
+        for key in sorted(recordings):
+            file.write(json.dumps(recordings[key], sort_keys=True) + '\n')
+
+
+class Recorder(object):
+    '''Record every response into self.recordings.'''
+    def __init__(self):
+        self.recordings = {}
+        self._lock = threading.Lock()
+
+    def request(self, session, method, url, params=None, data=None, json=None, **kwargs):
+        response = _ORIGINAL_REQUEST(
+            session, method, url, params=params, data=data, json=json, **kwargs)
+        recording = {
+            'key': request_key(method, url, params, data, json),
+            'status': response.status_code,
+            'headers': dict(response.headers),
+            'content': base64.b64encode(response.content),
+        }
+        with self._lock:
+            self.recordings[recording['key']] = recording
+        return response
+
+
+class Player(object):
+    '''Answer every request from recordings.'''
+    def __init__(self, recordings):
+        self.recordings = recordings
+        self.misses = 0
+
+    def request(self, session, method, url, params=None, data=None, json=None, **kwargs):
+        key = request_key(method, url, params, data, json)
+        recording = self.recordings.get(key)
+        if recording is None:
+            self.misses += 1
+            raise requests.exceptions.ConnectionError('No recording for {}'.format(key))
+
+        return build_response(url, recording)
+
+
+def install(backend):
+    '''Send every request made through requests to a Recorder or a Player.'''
+    def request(session, method, url, **kwargs):
+        return backend.request(session, method, url, **kwargs)
+
+    requests.sessions.Session.request = request
+
+
+def uninstall():
+    requests.sessions.Session.request = _ORIGINAL_REQUEST
@@ -0,0 +1,40 @@
+"""
+Compact representations of the data handlers hold on to.
+
+Treeherder returns dozens of fields per job but we only use a handful, and
+the same buildernames show up over and over in requests.
+"""
+# There are a few thousand buildernames; more than this means we keep stale ones
+MAX_NAMES = 20000
+_NAMES = {}
+
+
+def intern_name(name):
+    '''Return a shared copy of a buildername (intern() does not take unicode).'''
+    if len(_NAMES) >= MAX_NAMES and name not in _NAMES:
+        # Names in use keep their copies; they just stop being shared with new ones
+        _NAMES.clear()
+    return _NAMES.setdefault(name, name)
+
+
+def clear_names():
+    _NAMES.clear()
+
+
+class JobRecord(object):
+    '''The fields of a Treeherder job that handlers use.'''
+    __slots__ = ('id', 'build_system_type', 'job_guid', 'job_type_name', 'ref_data_name',
+                 'result_set_id')
+
+    def __init__(self, id, build_system_type, job_guid, job_type_name, ref_data_name,
+                 result_set_id):
+        self.id = id
+        self.build_system_type = intern_name(build_system_type)
+        self.job_guid = job_guid
+        self.job_type_name = intern_name(job_type_name)
+        self.ref_data_name = intern_name(ref_data_name)
+        self.result_set_id = result_set_id
+
+    @classmethod
+    def from_treeherder(cls, job):
+        return cls(**dict((field, job[field]) for field in cls.__slots__))
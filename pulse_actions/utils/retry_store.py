@@ -0,0 +1,203 @@
+"""
+This module keeps a durable record of the requests we failed to fulfill.
+
+Failed messages are stored in a SQLite database together with the traceback of the
+error, the number of attempts and the guid of the Treeherder job reported for them.
+RetryScheduler reprocesses them with exponential backoff until they succeed or we give
+up on them (they then stay in the store as dead letters). Messages which retrying cannot
+fix (e.g. invalid ones) are stored as dead letters right away.
+
+Requests which cannot run yet raise RetryLater (e.g. another worker holds their lease).
+They are deferred for the delay it gives without counting as a failed attempt.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+import traceback
+
+LOG = logging.getLogger(__name__)
+# Seconds to wait before the first retry; it doubles with every attempt
+BACKOFF_BASE = 60
+BACKOFF_MAX = 60 * 60
+MAX_ATTEMPTS = 6
+
+
+class RetryLater(Exception):
+    '''Raised by a request which has to be processed again after delay seconds.'''
+    def __init__(self, message, delay):
+        super(RetryLater, self).__init__(message)
+        self.delay = delay
+
+
+def backoff(attempts):
+    '''Return how many seconds to wait before attempting a request again.'''
+    return min(BACKOFF_BASE * (2 ** (attempts - 1)), BACKOFF_MAX)
+
+
+class FailedRequest(object):
+    __slots__ = ('id', 'data', 'error', 'attempts', 'created', 'next_attempt', 'job_guid')
+
+    def __init__(self, id, data, error, attempts, created, next_attempt, job_guid=None):
+        self.id = id
+        self.data = data
+        self.error = error
+        self.attempts = attempts
+        self.created = created
+        self.next_attempt = next_attempt
+        self.job_guid = job_guid
+
+    @property
+    def dead(self):
+        return self.next_attempt is None
+
+
+class RetryStore(object):
+    '''SQLite backed store of failed requests.
+
+    The connection is shared between the consumer and the retry scheduler threads.
+    '''
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS failed_requests ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'data TEXT NOT NULL, '
+                'error TEXT, '
+                'attempts INTEGER NOT NULL, '
+                'created REAL NOT NULL, '
+                'next_attempt REAL)'
+            )
+            # Stores created before we kept the Treeherder job of a request
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(failed_requests)')]
+            if 'job_guid' not in columns:
+                self._conn.execute('ALTER TABLE failed_requests ADD COLUMN job_guid TEXT')
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        return [FailedRequest(row[0], json.loads(row[1]), *row[2:]) for row in rows]
+
+    def _insert(self, data, error, attempts, next_attempt, job_guid):
+        self._execute(
+            'INSERT INTO failed_requests '
+            '(data, error, attempts, created, next_attempt, job_guid) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (json.dumps(data), error, attempts, time.time(), next_attempt, job_guid)
+        )
+
+    def _execute(self, sql, params=()):
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).rowcount
+
+    def add(self, data, error, job_guid=None):
+        '''Record a message which failed for the first time.
+
+        :param error: Traceback of the error
+        :param job_guid: Treeherder job reported for the message, if any
+        '''
+        self._insert(data, error, 1, time.time() + backoff(1), job_guid)
+
+    def defer(self, data, reason, delay, job_guid=None):
+        '''Record a message which has to wait delay seconds; it is not a failed attempt.'''
+        self._insert(data, reason, 0, time.time() + delay, job_guid)
+
+    def dead_letter(self, data, error):
+        '''Record a message which retrying would not help (e.g. an invalid one).'''
+        # With max_attempts a replay which fails does not schedule further retries
+        self._insert(data, error, self.max_attempts, None, None)
+
+    def failed_again(self, request, error):
+        '''Bump the attempts of a request; it becomes a dead letter after max_attempts.'''
+        attempts = request.attempts + 1
+        if attempts >= self.max_attempts:
+            LOG.warning('We have given up on request {} after {} attempts.'.format(
+                request.id, attempts))
+            next_attempt = None
+        else:
+            next_attempt = time.time() + backoff(attempts)
+
+        self._execute(
+            'UPDATE failed_requests SET error = ?, attempts = ?, next_attempt = ? WHERE id = ?',
+            (error, attempts, next_attempt, request.id)
+        )
+
+    def postpone(self, request, reason, delay):
+        '''Process a request again after delay seconds without bumping its attempts.'''
+        self._execute(
+            'UPDATE failed_requests SET error = ?, next_attempt = ? WHERE id = ?',
+            (reason, time.time() + delay, request.id)
+        )
+
+    def remove(self, request):
+        self._execute('DELETE FROM failed_requests WHERE id = ?', (request.id,))
+
+    def due(self, now=None):
+        '''Return the requests whose backoff has expired.'''
+        return self._query(
+            'SELECT * FROM failed_requests WHERE next_attempt IS NOT NULL AND next_attempt <= ? '
+            'ORDER BY next_attempt',
+            (now or time.time(),)
+        )
+
+    def all(self):
+        return self._query('SELECT * FROM failed_requests ORDER BY id')
+
+    def purge(self, dead_only=False):
+        '''Delete stored requests and return how many were deleted.'''
+        if dead_only:
+            return self._execute('DELETE FROM failed_requests WHERE next_attempt IS NULL')
+        return self._execute('DELETE FROM failed_requests')
+
+
+def retry(store, request, process_request):
+    '''Process a stored request once and update the store. Return True on success.
+
+    :param process_request: Called with the message and the guid of its Treeherder job
+    '''
+    try:
+        process_request(request.data, job_guid=request.job_guid)
+    except KeyboardInterrupt:
+        raise
+    except RetryLater as e:
+        LOG.info('Request {} has to wait {}s: {}'.format(request.id, e.delay, e))
+        store.postpone(request, reason=str(e), delay=e.delay)
+        return False
+    except Exception:
+        LOG.exception('Retry of request {} failed.'.format(request.id))
+        store.failed_again(request, error=traceback.format_exc())
+        return False
+
+    LOG.info('Request {} succeeded after {} failed attempts.'.format(
+        request.id, request.attempts))
+    store.remove(request)
+    return True
+
+
+class RetryScheduler(threading.Thread):
+    '''Background thread which reprocesses failed requests once their backoff expires.'''
+    def __init__(self, store, process_request, interval=30):
+        super(RetryScheduler, self).__init__(name='RetryScheduler')
+        self.daemon = True
+        self.store = store
+        self.process_request = process_request
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            for request in self.store.due():
+                if self._stop_event.is_set():
+                    break
+                retry(self.store, request, self.process_request)
+
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,187 @@
+"""
+This module validates Pulse messages before any work is done on their behalf.
+
+Each exchange we consume from has a schema listing the fields its handler uses, their
+types and where they are in the message. Schemas are compiled into validators when this
+module is imported. A validator checks a message and returns a typed event (e.g. a
+JobAction) with normalized values: ids are ints even if Treeherder sent strings and
+decisionTaskID is available as decision_task_id.
+
+Messages which do not match their schema raise InvalidMessage; the worker dead-letters
+them instead of reporting a job to Treeherder and failing inside the handler.
+"""
+from pulse_actions.utils.records import intern_name
+
+_MISSING = object()
+
+
+class InvalidMessage(Exception):
+    pass
+
+
+class Event(object):
+    '''Base class of the typed messages handlers receive.'''
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values[name])
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class PushAction(Event):
+    __slots__ = ('project', 'resultset_id', 'action', 'times', 'requester')
+
+
+class JobAction(Event):
+    __slots__ = ('project', 'job_id', 'action', 'requester')
+
+
+class NewJobsRequest(Event):
+    __slots__ = ('project', 'resultset_id', 'requested_jobs', 'requester', 'decision_task_id')
+
+
+class NormalizedBuild(Event):
+    __slots__ = ('buildername', 'revision', 'status', 'tree')
+
+
+def string(value):
+    if not isinstance(value, basestring):
+        raise TypeError('should be a string')
+    return value
+
+
+def integer(value):
+    '''Accept ints and strings of digits.'''
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, basestring) and value.isdigit():
+        return int(value)
+    raise TypeError('should be an integer')
+
+
+def string_list(value):
+    if not isinstance(value, list) or not all(isinstance(v, basestring) for v in value):
+        raise TypeError('should be a list of strings')
+    return value
+
+
+def interned(value):
+    '''A buildername, job type or the like; we keep a single copy of each.'''
+    return intern_name(string(value))
+
+
+class Field(object):
+    def __init__(self, name, kind, path=None, required=True, aliases=()):
+        '''
+        :param kind: Function which returns the normalized value or raises TypeError
+        :param path: Where the value is, e.g. 'payload.buildername'; defaults to name
+        :param aliases: Other paths tried in order if path is not in the message
+        '''
+        self.name = name
+        self.kind = kind
+        self.paths = [tuple(p.split('.')) for p in (path or name,) + tuple(aliases)]
+        self.required = required
+
+
+def _getter(paths):
+    '''Return a function which returns the first value found in paths or _MISSING.'''
+    if len(paths) == 1 and len(paths[0]) == 1:
+        key = paths[0][0]
+        return lambda data: data.get(key, _MISSING)
+
+    def get(data):
+        for path in paths:
+            value = data
+            for key in path:
+                value = value.get(key, _MISSING) if isinstance(value, dict) else _MISSING
+            if value is not _MISSING:
+                return value
+        return _MISSING
+    return get
+
+
+def compile_schema(event_class, fields):
+    '''Return a function which validates a message and returns an event_class.'''
+    assert [f.name for f in fields] == list(event_class.__slots__), event_class
+    checks = tuple((f.name, _getter(f.paths), f.kind, f.required) for f in fields)
+
+    def validate(data):
+        if not isinstance(data, dict):
+            raise InvalidMessage('{} should be a dict'.format(event_class.__name__))
+
+        values = {}
+        for field_name, get, kind, required in checks:
+            value = get(data)
+            if value is _MISSING or value is None:
+                if required:
+                    raise InvalidMessage('{} is missing'.format(field_name))
+                values[field_name] = None
+                continue
+
+            try:
+                values[field_name] = kind(value)
+            except (TypeError, ValueError) as e:
+                raise InvalidMessage('{} {} (got {!r:.80})'.format(field_name, e, value))
+
+        return event_class(**values)
+
+    return validate
+
+
+SCHEMAS = {
+    'exchange/treeherder/v1/resultset-actions': (PushAction, [
+        Field('project', string),
+        Field('resultset_id', integer),
+        Field('action', string),
+        Field('times', integer),
+        Field('requester', string),
+    ]),
+    'exchange/treeherder/v1/job-actions': (JobAction, [
+        Field('project', string),
+        Field('job_id', integer),
+        Field('action', string),
+        Field('requester', string),
+    ]),
+    'exchange/treeherder/v1/resultset-runnable-job-actions': (NewJobsRequest, [
+        Field('project', string),
+        Field('resultset_id', integer),
+        # Older messages have buildernames instead, which we do not support anymore
+        Field('requested_jobs', string_list),
+        Field('requester', string),
+        # Empty in non-try messages; remove decisionTaskID once bug 1286897 is fixed
+        Field('decision_task_id', string, required=False, aliases=('decisionTaskID',)),
+    ]),
+    'exchange/build/normalized': (NormalizedBuild, [
+        Field('buildername', interned, path='payload.buildername'),
+        Field('revision', string, path='payload.revision'),
+        Field('status', integer, path='payload.status'),
+        Field('tree', string, path='payload.tree'),
+    ]),
+}
+VALIDATORS = dict(
+    (exchange, compile_schema(*schema)) for exchange, schema in SCHEMAS.iteritems())
+
+
+def message_exchange(data, message):
+    '''Return the exchange a message came from or None if it does not say.
+
+    Replayed and stored messages have neither delivery information nor _meta.
+    '''
+    delivery_info = getattr(message, 'delivery_info', None)
+    if isinstance(delivery_info, dict) and isinstance(delivery_info.get('exchange'), basestring):
+        return delivery_info['exchange']
+
+    meta = data.get('_meta') if isinstance(data, dict) else None
+    return meta.get('exchange') if isinstance(meta, dict) else None
+
+
+def parse(exchange, data):
+    '''Return the event of a message from exchange or raise InvalidMessage.'''
+    validate = VALIDATORS.get(exchange)
+    if validate is None:
+        raise InvalidMessage('We have no schema for {}'.format(exchange))
+    return validate(data)
@@ -0,0 +1,200 @@
+"""
+This module runs the worker in shadow mode.
+
+In shadow mode every call with side effects we know of (scheduling graphs and action
+tasks, triggering BuildAPI jobs, submitting to Treeherder and uploading to S3) is captured
+instead of executed. The worker also runs in dry run mode, so a call we do not capture
+does nothing either, and it does not use leases. Read-only queries still hit the real
+services so the handlers make the same decisions they would make in production.
+
+For each message we write a JSON line with the intended actions and how long it took.
+If a baseline is given, each line also includes the actions which are missing or extra
+compared to it and the baseline's latency. The baseline is the output of a previous
+shadow run (e.g. of the deployed version on the same replay file); production does not
+record its actions, so we cannot compare against it directly.
+
+Messages come either from a replay file or from a mirrored Pulse queue, i.e. a config
+file with the same bindings as production but a different applabel.
+"""
+import hashlib
+import importlib
+import json
+import logging
+import threading
+
+from timeit import default_timer
+
+from pulse_actions.handlers import load_handler
+from pulse_actions.utils import trigger_executor
+
+LOG = logging.getLogger(__name__)
+# (module, attribute) of every call with side effects
+SIDE_EFFECTS = [
+    ('pulse_actions.handlers.talos_pgo_jobs', 'trigger_range'),
+    ('pulse_actions.handlers.treeherder_add_new_jobs', 'trigger_job'),
+    ('pulse_actions.handlers.treeherder_job_action', 'manual_backfill'),
+    ('pulse_actions.handlers.treeherder_push_action', 'trigger_range'),
+    ('mozci', 'TaskClusterBuildbotManager.schedule_graph'),
+    ('mozci.ci_manager', 'BuildAPIManager.trigger_missing_jobs_for_revision'),
+    ('mozci.taskcluster', 'TaskClusterManager.schedule_action_task'),
+    ('tc_s3_uploader', 'TC_S3_Uploader.upload'),
+]
+HANDLERS = [
+    'talos_pgo_jobs',
+    'treeherder_add_new_jobs',
+    'treeherder_job_action',
+    'treeherder_push_action',
+]
+_CURRENT = threading.local()
+
+
+def _canonical(value):
+    '''Return a JSON friendly version of value so actions can be compared.'''
+    return json.loads(json.dumps(value, default=repr, sort_keys=True))
+
+
+def message_id(data):
+    '''Return an id for a message which is stable across runs.'''
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=repr)).hexdigest()[:16]
+
+
+def record_action(name, args, kwargs):
+    actions = getattr(_CURRENT, 'actions', None)
+    if actions is None:
+        LOG.warning('Captured {} outside of a message.'.format(name))
+        return
+
+    # It is always set in shadow mode
+    kwargs.pop('dry_run', None)
+    actions.append(_canonical({'call': name, 'args': list(args), 'kwargs': kwargs}))
+
+
+def _capture(name, is_method):
+    if is_method:
+        def capture(self, *args, **kwargs):
+            record_action(name, args, kwargs)
+    else:
+        def capture(*args, **kwargs):
+            record_action(name, args, kwargs)
+    return capture
+
+
+def capture_side_effects():
+    '''Replace every call with side effects with one which records it.'''
+    # Handlers import these functions into their own namespace
+    for handler in HANDLERS:
+        load_handler(handler)
+
+    for module_name, attribute in SIDE_EFFECTS:
+        target = importlib.import_module(module_name)
+        path = attribute.split('.')
+        for part in path[:-1]:
+            target = getattr(target, part)
+
+        setattr(target, path[-1], _capture(attribute, is_method=len(path) > 1))
+        LOG.info('Shadow mode: capturing {}.{}'.format(module_name, attribute))
+
+    # The actions are recorded for the thread processing the message
+    trigger_executor.RUN_INLINE = True
+
+
+def run_captured(function, **kwargs):
+    '''Call function and return the actions it intended to take and the error it raised.'''
+    _CURRENT.actions = []
+    error = None
+    try:
+        function(**kwargs)
+    except (Exception, SystemExit) as e:
+        error = repr(e)
+    finally:
+        actions = _CURRENT.actions
+        _CURRENT.actions = None
+
+    return actions, error
+
+
+class CapturingJobFactory(object):
+    '''Stand-in for thsubmitter's TreeherderJobFactory.'''
+    def create_job(self, **kwargs):
+        return _canonical(kwargs)
+
+    def submit_running(self, job):
+        record_action('submit_running', [job], {})
+
+    def submit_completed(self, job, **kwargs):
+        record_action('submit_completed', [job], kwargs)
+
+
+def _read_baseline(path):
+    baseline = {}
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            baseline[record['id']] = record
+    return baseline
+
+
+def _key(action):
+    return json.dumps(action, sort_keys=True)
+
+
+def diff_actions(actions, baseline_actions):
+    ours = set(map(_key, actions))
+    theirs = set(map(_key, baseline_actions))
+    return {
+        'missing': [a for a in baseline_actions if _key(a) not in ours],
+        'extra': [a for a in actions if _key(a) not in theirs],
+    }
+
+
+class ShadowRun(object):
+    def __init__(self, output_path, baseline_path=None):
+        self.output = open(output_path, 'w')
+        self.baseline = _read_baseline(baseline_path) if baseline_path else None
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.seconds = 0.0
+        # Only messages which are also in the baseline
+        self.compared = 0
+        self.differing = 0
+        self.compared_seconds = 0.0
+        self.baseline_seconds = 0.0
+
+    def route(self, route, data, **kwargs):
+        '''Call route() and record the actions it intended to take.'''
+        start = default_timer()
+        actions, error = run_captured(route, data=data, **kwargs)
+        self._write(data, actions, default_timer() - start, error)
+
+    def _write(self, data, actions, seconds, error):
+        record = {
+            'id': message_id(data),
+            'actions': actions,
+            'error': error,
+            'seconds': round(seconds, 3),
+        }
+        with self._lock:
+            self.messages += 1
+            self.seconds += seconds
+            expected = self.baseline.get(record['id']) if self.baseline else None
+            if expected is not None:
+                record['diff'] = diff_actions(actions, expected['actions'])
+                record['baseline_seconds'] = expected['seconds']
+                self.compared += 1
+                self.compared_seconds += seconds
+                self.baseline_seconds += expected['seconds']
+                if record['diff']['missing'] or record['diff']['extra']:
+                    self.differing += 1
+                    LOG.warning('Shadow: {} differs from the baseline: {}'.format(
+                        record['id'], record['diff']))
+
+            self.output.write(json.dumps(record, sort_keys=True) + '\n')
+            self.output.flush()
+
+    def summary(self):
+        LOG.info('Shadow: {} messages took {:.1f}s.'.format(self.messages, self.seconds))
+        if self.baseline is not None:
+            LOG.info('Shadow: {} out of {} messages found in the baseline differ from it.'.format(
+                self.differing, self.compared))
+            LOG.info('Shadow: those messages took {:.1f}s; {:.1f}s in the baseline.'.format(
+                self.compared_seconds, self.baseline_seconds))
@@ -0,0 +1,61 @@
+"""
+This module keeps track of what it costs to start the worker.
+
+Heavy modules (mozci, thclient, taskcluster, boto3...) are imported on first use
+through timed_import(). The cost of each import and initialization step is reported
+once the worker is initialized and again when the first message arrives, so the
+restart-to-first-message latency can be tracked.
+"""
+import importlib
+import logging
+import sys
+import threading
+
+from contextlib import contextmanager
+from timeit import default_timer
+
+LOG = logging.getLogger(__name__)
+# This module is imported first by the worker
+PROCESS_START = default_timer()
+# List of (step, seconds)
+TIMINGS = []
+_FIRST_MESSAGE_LOCK = threading.Lock()
+_FIRST_MESSAGE_SEEN = False
+
+
+def timed_import(name):
+    '''Import a module and record how long it took the first time.'''
+    if name in sys.modules:
+        return sys.modules[name]
+
+    start = default_timer()
+    module = importlib.import_module(name)
+    TIMINGS.append(('import {}'.format(name), default_timer() - start))
+    return module
+
+
+@contextmanager
+def timed(step):
+    '''Record how long an initialization step takes.'''
+    start = default_timer()
+    yield
+    TIMINGS.append((step, default_timer() - start))
+
+
+def report(title):
+    LOG.info('{} ({:.2f}s since the process started):'.format(
+        title, default_timer() - PROCESS_START))
+    for step, seconds in sorted(TIMINGS, key=lambda timing: timing[1], reverse=True):
+        LOG.info('- {:.3f}s {}'.format(seconds, step))
+
+
+def first_message_received():
+    '''Report the startup cost the first time it is called.'''
+    global _FIRST_MESSAGE_SEEN
+
+    with _FIRST_MESSAGE_LOCK:
+        if _FIRST_MESSAGE_SEEN:
+            return
+        _FIRST_MESSAGE_SEEN = True
+
+    report('First message received')
@@ -0,0 +1,147 @@
+"""
+This module schedules TaskCluster action tasks on behalf of the handlers.
+
+TaskClusterManager instances (and their authenticated clients) are reused across
+requests. A request is submitted right away unless an action task for the same decision
+task and action is being submitted; the requests which arrive meanwhile are combined
+into the next submission. 'action-task' requests become a single action task with the
+union of their task labels and identical requests (e.g. two backfills of the same job)
+are only submitted once. A request on an idle worker is never delayed and every caller
+still gets its own outcome. Submissions go through the queue's controller in
+utils/throttling.py.
+"""
+import logging
+import threading
+
+from collections import OrderedDict
+
+from mozci.taskcluster import TaskClusterManager
+
+from pulse_actions.utils import throttling
+from pulse_actions.utils.log_util import request_ids, working_for
+
+LOG = logging.getLogger(__name__)
+# Action tasks are created through the queue and graphs through the scheduler
+QUEUE_HOST = 'queue.taskcluster.net'
+SCHEDULER_HOST = 'scheduler.taskcluster.net'
+
+
+class _Request(object):
+    def __init__(self, action_args):
+        self.action_args = action_args
+        # The leader logs on behalf of every request of the batch
+        self.request_ids = request_ids()
+        self.error = None
+        self.done = threading.Event()
+
+
+def merge_task_labels(requests):
+    '''Combine 'action-task' requests into one with all of their task labels.'''
+    labels = OrderedDict()
+    for request in requests:
+        for label in request.action_args['task_labels'].split(','):
+            labels[label] = True
+
+    action_args = dict(requests[0].action_args, task_labels=','.join(labels))
+    return [(action_args, requests)]
+
+
+def merge_identical(requests):
+    '''Only submit once the requests which have the same arguments.'''
+    groups = OrderedDict()
+    for request in requests:
+        key = tuple(sorted(request.action_args.items()))
+        groups.setdefault(key, []).append(request)
+
+    return [(group[0].action_args, group) for group in groups.values()]
+
+
+MERGERS = {
+    'action-task': merge_task_labels,
+}
+
+
+class ActionTaskScheduler(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Notified when a submission finishes
+        self._cond = threading.Condition(self._lock)
+        # Requests waiting for the submission in flight for their key
+        self._pending = {}
+        self._submitting = set()
+        self._managers = {}
+
+    def manager(self, dry_run):
+        '''Return a TaskClusterManager which is shared by all requests.'''
+        with self._lock:
+            if dry_run not in self._managers:
+                self._managers[dry_run] = TaskClusterManager(dry_run=dry_run)
+            return self._managers[dry_run]
+
+    def schedule_action_task(self, decision_id, action, action_args, dry_run):
+        '''Schedule an action task. It raises if the combined action task failed.'''
+        key = (decision_id, action, dry_run)
+        request = _Request(action_args)
+        with self._cond:
+            self._pending.setdefault(key, []).append(request)
+            while key in self._submitting:
+                self._cond.wait()
+
+            # The first request to get here submits every pending one; ours might have
+            # been submitted by the previous batch
+            requests = None if request.done.is_set() else self._pending.pop(key)
+            if requests:
+                self._submitting.add(key)
+
+        if requests:
+            try:
+                self._submit(key, requests)
+            finally:
+                with self._cond:
+                    self._submitting.discard(key)
+                    self._cond.notify_all()
+
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+    def _submit(self, key, requests):
+        with working_for(set(i for request in requests for i in request.request_ids)):
+            self._submit_batch(key, requests)
+
+    def _submit_batch(self, key, requests):
+        decision_id, action, dry_run = key
+        merge = MERGERS.get(action, merge_identical)
+        try:
+            action_tasks = merge(requests)
+        except Exception as e:
+            # Nobody can be left waiting
+            action_tasks = []
+            for request in requests:
+                request.error = e
+                request.done.set()
+
+        LOG.info('Scheduling {} {} action task(s) on {} for {} request(s).'.format(
+            len(action_tasks), action, decision_id, len(requests)))
+
+        for action_args, batch in action_tasks:
+            try:
+                throttling.controller(QUEUE_HOST).call(
+                    self.manager(dry_run).schedule_action_task,
+                    decision_id=decision_id,
+                    action=action,
+                    action_args=action_args
+                )
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            finally:
+                for request in batch:
+                    request.done.set()
+
+
+SCHEDULER = ActionTaskScheduler()
+
+
+def schedule_action_task(decision_id, action, action_args, dry_run):
+    SCHEDULER.schedule_action_task(decision_id, action, action_args, dry_run)
@@ -0,0 +1,241 @@
+"""
+This module keeps us from overloading the services we talk to.
+
+Controllers are keyed by host and path prefix, so e.g. BuildAPI's endpoints are
+throttled on their own while bulk downloads from the same host (allthethings.json) do
+not count against them. Requests go through the controller of their URL when they are
+made with a session install() was called on; callers which do not use a session of
+ours (e.g. BuildAPI triggers made by mozci) call a controller directly. A controller has:
+
+    - a token bucket which spaces out requests to at most `rate` per second
+    - an AIMD concurrency limit: it grows by one for every `limit` requests which were
+      answered faster than the target latency and it halves when the service answers
+      with a 429 or a 5xx, fails to answer or is slower than the target latency.
+      A 429's Retry-After also pauses the bucket.
+
+The current limits and how long requests waited for them are logged periodically and,
+if the New Relic agent is loaded, recorded as custom metrics.
+"""
+import logging
+import sys
+import threading
+import time
+
+from urlparse import urlsplit
+
+from requests import Response
+from requests.adapters import HTTPAdapter
+
+LOG = logging.getLogger(__name__)
+# Requests per second per controller unless configure() says otherwise
+DEFAULT_RATE = 10
+INITIAL_CONCURRENCY = 4
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 16
+# Seconds; slower responses count as a sign of overload
+TARGET_LATENCY = 10
+REPORT_INTERVAL = 60
+
+_LOCK = threading.Lock()
+# (host, path prefix) -> Controller
+_CONTROLLERS = {}
+# (host, path prefix) -> keyword arguments for its controller
+_SETTINGS = {}
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Take a token, waiting for it if needed, and return the seconds waited.'''
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens can go negative; each waiter sleeps until its own token is due
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self._paused_until - now, 0)
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+
+
+class AdaptiveLimit(object):
+    '''Concurrency limit with additive increase and multiplicative decrease.'''
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY,
+                 maximum=MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        '''Wait for a slot and return the seconds waited.'''
+        start = time.time()
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+        return time.time() - start
+
+    def release(self, overloaded):
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class Controller(object):
+    def __init__(self, host, path_prefix='/', rate=DEFAULT_RATE,
+                 max_concurrency=MAX_CONCURRENCY, target_latency=TARGET_LATENCY):
+        self.host = host
+        self.path_prefix = path_prefix
+        self.bucket = TokenBucket(rate)
+        self.concurrency = AdaptiveLimit(maximum=max_concurrency,
+                                         initial=min(INITIAL_CONCURRENCY, max_concurrency))
+        self.target_latency = target_latency
+        self._lock = threading.Lock()
+        # Metrics since the last report
+        self.requests = 0
+        self.overloaded = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+
+    def call(self, function, *args, **kwargs):
+        '''Call function (which makes a request to our host) within our limits.
+
+        function can return a requests Response or anything else (e.g. a trigger's exit
+        code); then only an exception or the latency are signs of overload.
+        '''
+        wait = self.bucket.acquire() + self.concurrency.acquire()
+        start = time.time()
+        response = raised = None
+        try:
+            response = function(*args, **kwargs)
+            return response
+        except BaseException:
+            raised = True
+            raise
+        finally:
+            overloaded = raised or self._overloaded(response, time.time() - start)
+            self.concurrency.release(overloaded)
+            with self._lock:
+                self.requests += 1
+                self.overloaded += overloaded
+                self.waited += wait
+                self.max_wait = max(self.max_wait, wait)
+
+    def _overloaded(self, response, latency):
+        if not isinstance(response, Response):
+            return latency > self.target_latency
+
+        if response.status_code == 429:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                self.bucket.pause(int(retry_after))
+            return True
+
+        return response.status_code >= 500 or latency > self.target_latency
+
+    @property
+    def name(self):
+        return self.host + self.path_prefix.rstrip('/')
+
+    def metrics(self):
+        '''Return the metrics since the last call and reset them.'''
+        with self._lock:
+            metrics = {
+                'rate': self.bucket.rate,
+                'concurrency_limit': int(self.concurrency.limit),
+                'requests': self.requests,
+                'overloaded': self.overloaded,
+                'throttle_wait': self.waited,
+                'max_throttle_wait': self.max_wait,
+            }
+            self.requests = self.overloaded = 0
+            self.waited = self.max_wait = 0.0
+        return metrics
+
+
+def configure(host, path_prefix='/', **kwargs):
+    '''Set the rate, max_concurrency or target_latency of a host's paths under path_prefix.'''
+    key = (host, path_prefix)
+    with _LOCK:
+        _SETTINGS.setdefault(key, {}).update(kwargs)
+        _CONTROLLERS.pop(key, None)
+
+
+def controller(host, path_prefix='/'):
+    key = (host, path_prefix)
+    with _LOCK:
+        if key not in _CONTROLLERS:
+            _CONTROLLERS[key] = Controller(host, path_prefix, **_SETTINGS.get(key, {}))
+        return _CONTROLLERS[key]
+
+
+def controller_for(url):
+    '''Return the controller of the longest configured path prefix of url.'''
+    parts = urlsplit(url)
+    with _LOCK:
+        prefixes = [prefix for host, prefix in _SETTINGS
+                    if host == parts.hostname and parts.path.startswith(prefix)]
+    return controller(parts.hostname, max(prefixes or ['/'], key=len))
+
+
+class ThrottledAdapter(HTTPAdapter):
+    '''Transport adapter which sends every request through its controller.'''
+    def send(self, request, **kwargs):
+        send = super(ThrottledAdapter, self).send
+        return controller_for(request.url).call(send, request, **kwargs)
+
+
+def install(session):
+    '''Throttle the requests made with a requests session and return it.'''
+    adapter = ThrottledAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def report():
+    '''Log the metrics of every host and record them in New Relic if it is loaded.'''
+    with _LOCK:
+        controllers = sorted(_CONTROLLERS.values(), key=lambda c: c.name)
+
+    newrelic_agent = sys.modules.get('newrelic.agent')
+    for host_controller in controllers:
+        metrics = host_controller.metrics()
+        LOG.info('{}: {requests} requests, {overloaded} overloaded, {rate}/s, concurrency limit '
+                 '{concurrency_limit}, waited {throttle_wait:.1f}s (at most '
+                 '{max_throttle_wait:.1f}s)'.format(host_controller.name, **metrics))
+        if newrelic_agent is not None:
+            for name, value in metrics.iteritems():
+                newrelic_agent.record_custom_metric(
+                    'Custom/Throttling/{}/{}'.format(host_controller.name, name), value)
+
+
+class Reporter(threading.Thread):
+    def __init__(self, interval=REPORT_INTERVAL):
+        super(Reporter, self).__init__(name='ThrottlingReporter')
+        self.daemon = True
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            report()
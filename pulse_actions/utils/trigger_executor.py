@@ -0,0 +1,97 @@
+"""
+This module triggers BuildAPI jobs concurrently.
+
+Handlers used to post to BuildAPI one builder at a time. trigger_in_parallel() runs
+the posts on a shared thread pool with a concurrency cap and collects the outcome of
+every trigger into a single TriggerResult. Each trigger goes through BuildAPI's
+controller in utils/throttling.py since mozci posts with requests sessions of its own;
+handlers which post to BuildAPI through mozci without the executor use call_buildapi().
+
+The talos handlers look up their builders through mozci and trigger each of them (with
+all of its repetitions) here rather than calling mozci's talos helpers, which trigger
+one builder after the other.
+"""
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pulse_actions.utils import throttling
+from pulse_actions.utils.log_util import request_ids, working_for
+
+LOG = logging.getLogger(__name__)
+BUILDAPI_HOST = 'secure.pub.build.mozilla.org'
+# The same host also serves bulk downloads (e.g. allthethings.json)
+BUILDAPI_PATH = '/buildapi/'
+# This can be changed by the worker before the first trigger
+CONCURRENCY = 4
+# Requests per second to BuildAPI
+RATE_LIMIT = 5
+# Run the triggers one after the other in the calling thread (e.g. when they are captured)
+RUN_INLINE = False
+
+_LOCK = threading.Lock()
+_EXECUTOR = None
+
+
+class TriggerResult(object):
+    def __init__(self):
+        self.succeeded = []
+        # List of (description, exception)
+        self.failed = []
+
+    @property
+    def exit_code(self):
+        return -1 if self.failed else 0
+
+    def __str__(self):
+        return '{} triggers succeeded and {} failed'.format(len(self.succeeded), len(self.failed))
+
+
+def _executor():
+    global _EXECUTOR
+
+    with _LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=CONCURRENCY)
+        return _EXECUTOR
+
+
+def call_buildapi(function, *args, **kwargs):
+    '''Call function, which posts to BuildAPI, within BuildAPI's limits.'''
+    return throttling.controller(BUILDAPI_HOST, BUILDAPI_PATH).call(function, *args, **kwargs)
+
+
+def _run(ids, function, kwargs):
+    # What the trigger logs belongs to the log of the request which asked for it
+    with working_for(ids):
+        return call_buildapi(function, **kwargs)
+
+
+def trigger_in_parallel(triggers):
+    '''Run every trigger and return a TriggerResult.
+
+    :param triggers: List of (description, function, kwargs)
+    '''
+    def start(function, kwargs):
+        '''Return a function which waits for the trigger to be done.'''
+        if RUN_INLINE:
+            return lambda: call_buildapi(function, **kwargs)
+        return _executor().submit(_run, request_ids(), function, kwargs).result
+
+    pending = [
+        (description, start(function, kwargs))
+        for description, function, kwargs in triggers
+    ]
+
+    result = TriggerResult()
+    for description, wait in pending:
+        try:
+            wait()
+            result.succeeded.append(description)
+        except Exception as e:
+            LOG.warning('Failed to trigger {}: {}'.format(description, e))
+            result.failed.append((description, e))
+
+    LOG.info('BuildAPI: {}.'.format(result))
+    return result
@@ -1,50 +1,72 @@
+# Imported first to measure the startup cost
+from pulse_actions.utils.startup import (
+    first_message_received,
+    report as report_startup,
+    timed,
+    timed_import,
+)
+
 import json
 import logging
 import os
 import sys
+import threading
+import time
 import traceback
 
 from argparse import ArgumentParser
+from contextlib import contextmanager
 from timeit import default_timer
 
-from amqp.exceptions import ConsumerCancelled
-
-import pulse_actions.handlers.treeherder_job_action as treeherder_job_action
-import pulse_actions.handlers.treeherder_push_action as treeherder_push_action
-import pulse_actions.handlers.treeherder_add_new_jobs as treeherder_add_new_jobs
-import pulse_actions.handlers.talos_pgo_jobs as talos_pgo_jobs
-
+from pulse_actions.handlers import before_first_handler, load_handler
+from pulse_actions.utils.builders_cache import setup_builders_cache
+from pulse_actions.utils.config_watcher import (
+    ConfigWatcher,
+    bindings,
+    config_changes,
+    update_bindings,
+)
+from pulse_actions.utils.connection import ConnectionManager
+from pulse_actions.utils.leases import LEASE_WAIT, LeaseService, create_backend
 from pulse_actions.utils.log_util import (
+    Sampler,
     end_logging,
     setup_logging,
     start_logging,
 )
+from pulse_actions.utils.lanes import (
+    LaneScheduler,
+    create_lane_consumer,
+    create_lanes,
+    unbind_other_lanes,
+)
+from pulse_actions.utils.memory import MemoryBudget
+from pulse_actions.utils.profiling import DEFAULT_DIR, KEEP_SLOWEST, Profiler
+from pulse_actions.utils.push_index import (
+    INDEX as PUSH_INDEX,
+    create_index_consumer,
+    lookup_job,
+    lookup_revision,
+)
+from pulse_actions.utils.records import clear_names
+from pulse_actions.utils.retry_store import RetryLater, RetryScheduler, RetryStore, retry
+from pulse_actions.utils.schemas import (
+    InvalidMessage,
+    NormalizedBuild,
+    message_exchange,
+    parse,
+)
+from pulse_actions.utils.shadow import CapturingJobFactory, ShadowRun, capture_side_effects
+from pulse_actions.utils import throttling, trigger_executor
 
 # Third party modules
-import newrelic.agent
+# mozci, thsubmitter, tc_s3_uploader and newrelic are imported on first use (see timed_import)
 from kombu.exceptions import MessageStateError
-from mozci.mozci import disable_validations
-from mozci.query_jobs import TreeherderApi
-from mozci.utils import transfer
 from replay import create_consumer, replay_messages
-from thsubmitter import (
-    JobEndResult,
-    TreeherderSubmitter,
-    TreeherderJobFactory
-)
-from tc_s3_uploader import TC_S3_Uploader
-
-# This changes the behaviour of mozci in transfer.py
-transfer.MEMORY_SAVING_MODE = False
-transfer.SHOW_PROGRESS_BAR = False
 
 # Constants
 JOB_SUCCESS = 0
 JOB_FAILURE = -1
-EXIT_CODE_JOB_RESULT_MAP = {
-    JOB_SUCCESS: JobEndResult.SUCCESS,
-    JOB_FAILURE: JobEndResult.FAIL
-}
 FILE_BUG = "https://bugzilla.mozilla.org/enter_bug.cgi?assigned_to=nobody%40mozilla.org&cc=armenzg%40mozilla.com&comment=Provide%20link.&component=General&form_name=enter_bug&product=Testing&short_desc=pulse_actions%20-%20Brief%20description%20of%20failure"  # flake8: noqa
 REQUIRED_ENV_VARIABLES = [
     'LDAP_USER',  # To post jobs to BuildApi
@@ -56,9 +78,41 @@ REQUIRED_ENV_VARIABLES = [
     'PULSE_USER',  # To create Pulse queues and consume from them
     'PULSE_PW',
 ]
+# Where the request logs are uploaded
+S3_HOST = 's3.amazonaws.com'
+
+# Each entry is (handler module, exchange, does the message belong to it?, post to Treeherder?)
+# Messages are routed by their exchange; the third element is for messages which do not
+# say where they came from (e.g. replayed or stored ones)
+# The handler modules are only imported once a message is routed to them
+ROUTES = (
+    ('treeherder_job_action', 'exchange/treeherder/v1/job-actions',
+     lambda data: 'job_id' in data, True),
+    ('treeherder_add_new_jobs', 'exchange/treeherder/v1/resultset-runnable-job-actions',
+     lambda data: 'buildernames' in data or 'requested_jobs' in data, True),
+    ('treeherder_push_action', 'exchange/treeherder/v1/resultset-actions',
+     lambda data: 'resultset_id' in data, True),
+    # XXX: Maybe this information could be configured per handler
+    ('talos_pgo_jobs', 'exchange/build/normalized', lambda data: 'payload' in data, False),
+)
+HANDLER_EXCHANGES = dict((route[0], route[1]) for route in ROUTES)
 
 # Global variables
 LOG = None
+# Set if we submit to Treeherder; reloading the config can turn it on later
+JOB_FACTORY = None
+# Log at most one ignored message per handler every 10 seconds
+IGNORED_SAMPLER = Sampler(interval=10)
+# Set if --retry-store is used; it keeps the requests we failed to fulfill
+RETRY_STORE = None
+# Set if --memory-budget is used
+MEMORY_BUDGET = None
+# Set if --leases is used; it coordinates the workers sharing our Pulse queue
+LEASES = None
+# Set if --shadow is used
+SHADOW = None
+# Set up in run(); profiling can be turned on with --profile or SIGUSR2
+PROFILER = None
 TH_SCH_JOB = "Treeherder 'Sch' job"  # This guarantees using a proper filter for Papertrail
 # These values are used inside of message_handler
 CONFIG = {
@@ -77,20 +131,41 @@ CONFIG = {
     'submit_to_treeherder': False,
     'treeherder_server_url': 'https://treeherder.mozilla.org',
 }
+# CONFIG is replaced (never modified) when the config file is reloaded; each message
+# keeps using the CONFIG it started with
+_MESSAGE = threading.local()
 
 
-@newrelic.agent.background_task()
 def main():
-    global CONFIG, LOG, JOB_FACTORY
+    # newrelic-admin run-program imports the agent; otherwise New Relic is not configured
+    if 'newrelic.agent' in sys.modules or 'NEW_RELIC_LICENSE_KEY' in os.environ:
+        newrelic_agent = timed_import('newrelic.agent')
+        newrelic_agent.background_task()(run)()
+    else:
+        run()
+
+
+def run():
+    global CONFIG, LOG, JOB_FACTORY, LEASES, MEMORY_BUDGET, PROFILER, RETRY_STORE, SHADOW
 
     # 0) Parse the command line arguments
     options = parse_args()
 
     # 1) Set up logging
+    json_format = options.json_logs or os.environ.get('LOG_FORMAT') == 'json'
     if options.debug or os.environ.get('LOGGING_LEVEL') == 'debug':
-        LOG = setup_logging(logging.DEBUG)
+        LOG = setup_logging(logging.DEBUG, json_format=json_format)
     else:
-        LOG = setup_logging(logging.INFO)
+        LOG = setup_logging(logging.INFO, json_format=json_format)
+
+    # 1.1) Open the store of failed requests
+    retry_store_path = options.retry_store or os.environ.get('RETRY_STORE')
+    if retry_store_path:
+        RETRY_STORE = RetryStore(retry_store_path)
+
+    if options.list_retries or options.purge_retries:
+        manage_retry_store(RETRY_STORE, purge=options.purge_retries)
+        return
 
     # 2) Check required environment variables
     if options.load_env_variables:
@@ -102,7 +177,10 @@ def main():
                 # Do not print the value as it could be a secret
                 LOG.info('Set {}'.format(env))
 
-    CONFIG['dry_run'] = options.dry_run or options.replay_file is not None or CONFIG['dry_run']
+    # Shadow mode captures the side effects it knows about; dry run mode covers the rest
+    shadow = options.shadow is not None
+    CONFIG['dry_run'] = shadow or options.dry_run or options.replay_file is not None or \
+        CONFIG['dry_run']
 
     if not CONFIG['dry_run']:
         fail_check = False
@@ -115,9 +193,55 @@ def main():
             LOG.error('Please set all the missing environment variables above.')
             sys.exit(1)
 
-    # 3) Enable memory saving (useful for Heroku)
-    if options.memory_saving:
-        transfer.MEMORY_SAVING_MODE = True
+    # 3) Enable memory saving (useful for Heroku); mozci is configured once a handler needs it
+    configure_mozci(memory_saving=options.memory_saving)
+
+    # 3.1) Load mozci's builders dataset from our persistent cache
+    builders_cache_dir = options.builders_cache or os.environ.get('BUILDERS_CACHE')
+    if builders_cache_dir and options.memory_saving:
+        # The cache keeps the whole dataset in memory, which memory saving mode avoids
+        LOG.warning('We do not use the builders cache in memory saving mode.')
+    elif builders_cache_dir:
+        def load_builders_cache():
+            with timed('load builders cache'):
+                setup_builders_cache(builders_cache_dir)
+
+        # It hands the dataset to mozci, which is only imported by the handlers
+        before_first_handler(load_builders_cache)
+
+    # 3.2) Keep the worker within a memory budget
+    memory_budget = options.memory_budget or os.environ.get('MEMORY_BUDGET')
+    if memory_budget:
+        MEMORY_BUDGET = create_memory_budget(int(memory_budget),
+                                             trace_allocations=options.trace_allocations)
+
+    # 3.3) Profile slow messages
+    PROFILER = Profiler(
+        handler_name=handler_name,
+        output_dir=options.profile_dir,
+        keep=options.profile_keep,
+        threshold=options.profile_threshold,
+    )
+    PROFILER.install_signal_handler()
+    if options.profile:
+        PROFILER.toggle()
+
+    # 3.4) Limit how hard we hit the services we depend on
+    trigger_executor.CONCURRENCY = options.trigger_concurrency
+    throttling.configure(trigger_executor.BUILDAPI_HOST, trigger_executor.BUILDAPI_PATH,
+                         rate=options.trigger_rate)
+    throttling.Reporter().start()
+
+    # 3.5) Coordinate with other workers so a push is not acted upon twice at the same time
+    leases_url = options.leases or os.environ.get('LEASES')
+    if leases_url and shadow:
+        # A shadow worker must not hold up the production workers sharing the leases
+        LOG.warning('Shadow mode does not use leases.')
+    elif leases_url and RETRY_STORE is None:
+        LOG.error('Leases need --retry-store to defer the requests for a busy push.')
+        sys.exit(1)
+    elif leases_url:
+        LEASES = LeaseService(create_backend(leases_url), wait=options.lease_wait)
 
     # 4) Set the treeherder host
     if options.config_file and options.treeherder_server_url:
@@ -148,7 +272,8 @@ def main():
     # 5) Set few constants which are used by message_handler
     if CONFIG['dry_run']:
         CONFIG['submit_to_treeherder'] = False
-        CONFIG['acknowledge'] = False
+        # A shadow worker consumes from a queue of its own
+        CONFIG['acknowledge'] = shadow
 
     if options.submit_to_treeherder or os.environ.get('SUBMIT_TO_TREEHERDER'):
         CONFIG['submit_to_treeherder'] = True
@@ -160,16 +285,23 @@ def main():
         CONFIG['route'] = False
 
     # 6) Set up the treeherder submitter
-    if CONFIG['submit_to_treeherder']:
-        JOB_FACTORY = initialize_treeherder_submission(
-            server_url=CONFIG['treeherder_server_url'],
-            client=os.environ['TREEHERDER_CLIENT_ID'],
-            secret=os.environ['TREEHERDER_SECRET'],
-            dry_run=CONFIG['dry_run']
-        )
+    if shadow:
+        with timed('set up shadow mode'):
+            SHADOW = ShadowRun(output_path=options.shadow, baseline_path=options.shadow_baseline)
+            capture_side_effects()
+            JOB_FACTORY = CapturingJobFactory()
+            CONFIG['submit_to_treeherder'] = True
+
+    elif CONFIG['submit_to_treeherder']:
+        with timed('initialize Treeherder submission'):
+            JOB_FACTORY = initialize_treeherder_submission(
+                server_url=CONFIG['treeherder_server_url'],
+                client=os.environ['TREEHERDER_CLIENT_ID'],
+                secret=os.environ['TREEHERDER_SECRET'],
+                dry_run=CONFIG['dry_run']
+            )
 
-    # 7) XXX: Disable mozci's validations (this might not be needed anymore)
-    disable_validations()
+    report_startup('Worker initialized')
 
     # 8) Determine if normal run is requested or replaying of saved messages
     if options.replay_file:
@@ -178,46 +310,85 @@ def main():
             process_message=message_handler,
             dry_run=True,
         )
+        if SHADOW is not None:
+            SHADOW.summary()
+    elif options.replay_retries:
+        replay_failed_requests(RETRY_STORE)
     else:
         # Normal execution path
-        run_listener(config_file=options.config_file)
+        run_listener(config_file=options.config_file, push_index=options.push_index)
+
+
+def configure_mozci(memory_saving):
+    '''Configure mozci before the first handler imports it.'''
+    def configure():
+        with timed('configure mozci'):
+            # This changes the behaviour of mozci in transfer.py
+            transfer = timed_import('mozci.utils.transfer')
+            transfer.MEMORY_SAVING_MODE = memory_saving
+            transfer.SHOW_PROGRESS_BAR = False
+
+            # XXX: Disable mozci's validations (this might not be needed anymore)
+            timed_import('mozci.mozci').disable_validations()
+
+    before_first_handler(configure)
+
+
+def create_memory_budget(limit_mb, trace_allocations=False):
+    budget = MemoryBudget(limit_mb, trace_allocations=trace_allocations)
+
+    def clear_mozci_caches():
+        # Only if the handlers have imported them
+        if 'mozci.sources.buildjson' in sys.modules:
+            sys.modules['mozci.sources.buildjson'].BUILDS_CACHE = {}
+        if 'mozci.query_jobs' in sys.modules:
+            sys.modules['mozci.query_jobs'].JOBS_CACHE = {}
+
+    budget.register_cache('mozci caches', clear_mozci_caches)
+    budget.register_cache('interned buildernames', clear_names)
+    budget.register_cache('push index', PUSH_INDEX.clear)
+    return budget
 
 
 def initialize_treeherder_submission(server_url, client, secret, dry_run):
+    thsubmitter = timed_import('thsubmitter')
     # 1) Object to submit jobs
-    th = TreeherderSubmitter(
+    th = thsubmitter.TreeherderSubmitter(
         server_url=server_url,
         treeherder_client_id=client,
         treeherder_secret=secret,
         dry_run=dry_run,
     )
-    return TreeherderJobFactory(submitter=th)
-
-
-def _determine_repo_revision(data, treeherder_server_url):
-    ''' Return repo_name and revision based on Pulse message data.'''
-    query = TreeherderApi(server_url=treeherder_server_url)
-
-    if 'project' in data:
-        repo_name = data['project']
-        if 'job_id' in data:
-            revision = query.query_revision_for_job(
-                repo_name=repo_name,
-                job_id=data['job_id']
-            )
-        elif 'resultset_id' in data:
-            revision = query.query_revision_for_resultset(
-                repo_name=repo_name,
-                resultset_id=data['resultset_id']
-            )
-        else:
-            LOG.error('We should have been able to determine the repo and revision')
-            sys.exit(1)
-    elif data['_meta']['exchange'] == 'exchange/build/normalized':
-        repo_name = data['payload']['tree']
-        revision = data['payload']['revision']
+    return thsubmitter.TreeherderJobFactory(submitter=th)
+
+
+def _job_result(exit_code):
+    JobEndResult = timed_import('thsubmitter').JobEndResult
+    return {
+        JOB_SUCCESS: JobEndResult.SUCCESS,
+        JOB_FAILURE: JobEndResult.FAIL
+    }[exit_code]
+
+
+def _determine_repo_revision(event, treeherder_server_url):
+    ''' Return repo_name and revision of a message's event.'''
+    if isinstance(event, NormalizedBuild):
+        return event.tree, event.revision
+
+    repo_name = event.project
+    # What we fetch is added to the push index, so the handler does not fetch it again
+    treeherder_client = timed_import('pulse_actions.utils.misc').create_treeherder_client(
+        treeherder_server_url)
+    if hasattr(event, 'job_id'):
+        job = lookup_job(treeherder_client, repo_name, event.job_id)
+        if job is None:
+            raise LookupError('Treeherder does not know job {} of {}'.format(
+                event.job_id, repo_name))
+        push_id = job.result_set_id
+    else:
+        push_id = event.resultset_id
 
-    return repo_name, revision
+    return repo_name, lookup_revision(treeherder_client, repo_name, push_id)
 
 
 # Pulse consumer's callback passes only data and message arguments
@@ -226,41 +397,141 @@ def message_handler(data, message, *args, **kwargs):
     ''' Handle pulse message, log to file, upload and report to Treeherder
     '''
     if CONFIG['route']:
-        try:
-            if CONFIG['acknowledge']:
-                LOG.info('Message acknowledged')
-                message.ack()
-            route(data=data, message=message, dry_run=CONFIG['dry_run'],
-                  treeherder_server_url=CONFIG['treeherder_server_url'])
-        except KeyboardInterrupt:
-            # We want to get out of run_listener()
-            raise
-        except:
-            LOG.exception('Failed to fulfill request.')
+        acknowledge(message)
+        process_message(data, message)
     else:
         LOG.info("We're not routing messages")
 
 
+@contextmanager
+def message_config(job_guid=None):
+    '''Use the same CONFIG for the whole message even if it gets reloaded meanwhile.
+
+    :param job_guid: Treeherder job to report to; retried requests reuse the job of
+                     their first attempt. It is kept after the message so a failed one
+                     can be stored with it.
+    '''
+    _MESSAGE.config = CONFIG
+    _MESSAGE.job_guid = job_guid
+    try:
+        yield _MESSAGE.config
+    finally:
+        _MESSAGE.config = None
+
+
+def current_config():
+    return getattr(_MESSAGE, 'config', None) or CONFIG
+
+
+def acknowledge(message):
+    # Messages have to be acknowledged from the thread consuming them
+    if CONFIG['acknowledge']:
+        LOG.info('Message acknowledged')
+        message.ack()
+
+
+def process_message(data, message):
+    '''Route an acknowledged message and store it for later if it fails.'''
+    first_message_received()
+    try:
+        with message_config() as config:
+            kwargs = {
+                'dry_run': config['dry_run'],
+                'treeherder_server_url': config['treeherder_server_url'],
+            }
+            if SHADOW is not None:
+                SHADOW.route(route, data=data, message=message, **kwargs)
+            elif PROFILER is not None:
+                with PROFILER.profile(data, message):
+                    route(data=data, message=message, **kwargs)
+            else:
+                route(data=data, message=message, **kwargs)
+    except KeyboardInterrupt:
+        # We want to get out of run_listener()
+        raise
+    except RetryLater as e:
+        LOG.info('%s; we will process the request again in %ss.', e, e.delay)
+        if RETRY_STORE is not None:
+            RETRY_STORE.defer(data, reason=str(e), delay=e.delay, job_guid=_MESSAGE.job_guid)
+    except InvalidMessage as e:
+        # Retrying would not make it valid
+        LOG.warning('Invalid message (%s): %.200s', e, data)
+        if RETRY_STORE is not None:
+            RETRY_STORE.dead_letter(data, error=traceback.format_exc())
+    except:
+        LOG.exception('Failed to fulfill request.')
+        if RETRY_STORE is not None:
+            RETRY_STORE.add(data, error=traceback.format_exc(), job_guid=_MESSAGE.job_guid)
+            LOG.info('The request has been stored to be retried later.')
+    finally:
+        if MEMORY_BUDGET is not None:
+            MEMORY_BUDGET.check()
+
+
+def process_failed_request(data, job_guid=None):
+    '''Route a stored request again; any exception means it failed once more.'''
+    with message_config(job_guid) as config:
+        route(data=data, message=None, dry_run=config['dry_run'],
+              treeherder_server_url=config['treeherder_server_url'])
+
+
+def manage_retry_store(store, purge=False):
+    '''List the failed requests kept in the store and optionally delete them.'''
+    if store is None:
+        LOG.error('Please use --retry-store to tell us where the failed requests are.')
+        sys.exit(1)
+
+    for request in store.all():
+        LOG.info('{} attempts: {} dead: {} - {}'.format(
+            request.id, request.attempts, request.dead, request.data))
+        # Only the last line of the traceback; some exceptions have no message
+        lines = (request.error or '').strip().splitlines()
+        LOG.info('  Error: {}'.format(lines[-1] if lines else 'unknown'))
+
+    if purge:
+        LOG.info('Purged {} failed requests.'.format(store.purge()))
+
+
+def replay_failed_requests(store):
+    '''Process every stored request once, ignoring the backoff.'''
+    if store is None:
+        LOG.error('Please use --retry-store to tell us where the failed requests are.')
+        sys.exit(1)
+
+    requests = store.all()
+    succeeded = [r for r in requests if retry(store, r, process_failed_request)]
+    LOG.info('{} out of {} failed requests succeeded.'.format(len(succeeded), len(requests)))
+
+
 def start_request(repo_name, revision):
+    config = current_config()
     results = {
         # Set the level to INFO to ensure that no debug messages could leak anything
         # to the public
         'log_path': start_logging(log_level=logging.INFO),
         'start_time': default_timer(),
-        'treeherder_job': None
+        'treeherder_job': None,
+        # The config can replace JOB_FACTORY before the request ends
+        'job_factory': JOB_FACTORY,
     }
 
     # 1) Report as running to Treeherder
-    if CONFIG['submit_to_treeherder']:
-        treeherder_job = JOB_FACTORY.create_job(
+    if config['submit_to_treeherder']:
+        treeherder_job = results['job_factory'].create_job(
             repository=repo_name,
             revision=revision,
             add_platform_info=True,
-            dry_run=CONFIG['dry_run'],
-            **CONFIG['pulse_actions_job_template']
+            dry_run=config['dry_run'],
+            **config['pulse_actions_job_template']
         )
+        # Report a retried request to the job of its first attempt instead of a new one
+        job_guid = getattr(_MESSAGE, 'job_guid', None)
+        if job_guid is not None and hasattr(treeherder_job, 'job_guid'):
+            treeherder_job.job_guid = job_guid
+        _MESSAGE.job_guid = getattr(treeherder_job, 'job_guid', None)
         try:
-            JOB_FACTORY.submit_running(treeherder_job)
+            throttling.controller_for(config['treeherder_server_url']).call(
+                results['job_factory'].submit_running, treeherder_job)
             results['treeherder_job'] = treeherder_job
         except KeyboardInterrupt:
             raise
@@ -272,29 +543,33 @@ def start_request(repo_name, revision):
     return results
 
 
-def end_request(exit_code, data, log_path, treeherder_job, start_time):
+def end_request(exit_code, data, log_path, treeherder_job, start_time, job_factory):
     '''End logging, upload to S3 and submit to Treeherder'''
     # 1) Let's stop the logging
     LOG.info('Seconds to execute: {}'.format(str(int(default_timer() - start_time))))
-    LOG.info('- Message {}'.format(str(data)))
+    LOG.info('- Message %s', data)
 
-    if CONFIG['submit_to_treeherder']:
+    config = current_config()
+    if config['submit_to_treeherder']:
         if treeherder_job is None:
             LOG.warning("As mentioned above we did not schedule a {}.".format(TH_SCH_JOB))
         else:
             try:
                 # XXX: We will add multiple logs in the future
-                s3_uploader = TC_S3_Uploader(bucket_prefix='ateam/pulse-action-dev/')
-                url = s3_uploader.upload(log_path)
+                tc_s3_uploader = timed_import('tc_s3_uploader')
+                s3_uploader = tc_s3_uploader.TC_S3_Uploader(
+                    bucket_prefix='ateam/pulse-action-dev/')
+                url = throttling.controller(S3_HOST).call(s3_uploader.upload, log_path)
                 LOG.info('Log uploaded to {}'.format(url))
             except Exception as e:
                 LOG.error(str(e))
                 LOG.error("We have failed to upload to S3; Let's not fail to complete the job")
                 url = 'http://people.mozilla.org/~armenzg/failure.html'
 
-            JOB_FACTORY.submit_completed(
+            throttling.controller_for(config['treeherder_server_url']).call(
+                job_factory.submit_completed,
                 job=treeherder_job,
-                result=EXIT_CODE_JOB_RESULT_MAP[exit_code],
+                result=_job_result(exit_code),
                 job_info_details_panel=[
                     {
                         "url": FILE_BUG,
@@ -318,41 +593,48 @@ def end_request(exit_code, data, log_path, treeherder_job, start_time):
     end_logging(log_path)
 
 
-def route(data, message, **kwargs):
-    ''' We need to map every exchange/topic to a specific handler.'''
-    post_to_treeherder = True
+def find_handler(data, message=None):
+    '''Return the name of the handler for a message and if it posts to Treeherder.'''
+    exchange = message_exchange(data, message)
+    for name, handler_exchange, belongs_to_handler, post_to_treeherder in ROUTES:
+        if exchange == handler_exchange if exchange else belongs_to_handler(data):
+            return name, post_to_treeherder
+    return None, False
 
-    # XXX: This is not ideal; we should define in the config which exchange uses which handler
-    # XXX: Specify here which treeherder host
-    if 'job_id' in data:
-        ignored = treeherder_job_action.ignored
-        handler = treeherder_job_action.on_event
 
-    elif 'buildernames' in data or 'requested_jobs' in data:
-        ignored = treeherder_add_new_jobs.ignored
-        handler = treeherder_add_new_jobs.on_event
+def handler_name(data, message=None):
+    return find_handler(data, message)[0] or 'unsupported'
 
-    elif 'resultset_id' in data:
-        ignored = treeherder_push_action.ignored
-        handler = treeherder_push_action.on_event
 
-    elif data['_meta']['exchange'] == 'exchange/build/normalized':
-        # XXX: Maybe this information could be configured per handler
-        post_to_treeherder = False
-        ignored = talos_pgo_jobs.ignored
-        handler = talos_pgo_jobs.on_event
+def parse_event(name, data):
+    '''Return the typed event a handler receives for a message or raise InvalidMessage.'''
+    return parse(HANDLER_EXCHANGES[name], data)
 
-    else:
-        LOG.error("Exchange not supported by router (%s)." % data)
 
-
-    if ignored(data):
-        LOG.info('Message {}'.format(str(data)[:120]))
+def route(data, message, **kwargs):
+    ''' We need to map every exchange/topic to a specific handler.'''
+    # XXX: Specify here which treeherder host
+    name, post_to_treeherder = find_handler(data, message)
+    if name is None:
+        LOG.error("Exchange not supported by router (%s)." % data)
+        return
+
+    # Invalid messages are rejected before we do anything on their behalf
+    event = parse_event(name, data)
+    handler_module = load_handler(name)
+    ignored = handler_module.ignored
+    handler = handler_module.on_event
+
+    if ignored(event):
+        # These can be many (e.g. build/normalized) so we only log a sample of them
+        log_it, skipped = IGNORED_SAMPLER.sample(name)
+        if log_it:
+            LOG.info('Message %.120s (%d similar messages were not logged)', data, skipped)
     elif not post_to_treeherder:
         try:
             LOG.info('#### New automatic request ####.')
-            handler(data=data, message=message, **kwargs)
-            LOG.info('Message {}'.format(str(data)))
+            handler(data=event, message=message, **kwargs)
+            LOG.info('Message %s', data)
             LOG.info('#### End of automatic request ####.')
         except MessageStateError as e:
             # I'm trying to fix the improper use of requeue in a previous patch
@@ -360,42 +642,66 @@ def route(data, message, **kwargs):
         except KeyboardInterrupt:
             raise
         except:
-            LOG.exception('Failed automatic action.')
+            LOG.error('Failed automatic action.')
+            # The caller decides if the request should be retried
+            raise
 
     else:
         # * Each request is logged into a unique file
         # * Upload each log file to S3
         # * Report the request to Treeherder first as running and then as complete
         LOG.info('#### New user request ####.')
-        # 1) Log request
-        repo_name, revision = _determine_repo_revision(data, CONFIG['treeherder_server_url'])
-        end_request_kwargs = start_request(repo_name=repo_name, revision=revision)
+        repo_name, revision = _determine_repo_revision(
+            event, current_config()['treeherder_server_url'])
 
-        # 2) Process request
-        try:
-            exit_code = handler(data=data, message=message, repo_name=repo_name,
-                                revision=revision, **kwargs)
-        except MessageStateError as e:
-            # I'm trying to fix the improper use of requeue in a previous patch
-            LOG.warning(str(e))
-            exit_code = JOB_FAILURE
-        except KeyboardInterrupt:
-            raise
-        except:
-            LOG.exception('The handler failed to do is job. We will mark the job as failed')
-            exit_code = JOB_FAILURE
+        # 1) Make sure no other worker is acting on the same push and action
+        lease = None
+        if LEASES is not None:
+            lease = LEASES.claim(repo_name, revision, action=getattr(event, 'action', name),
+                                 job_id=getattr(event, 'job_id', None))
+            if lease is None:
+                return
 
-        # XXX: Until handlers can guarantee an exit_code
-        if not exit_code:
-            LOG.warning('The handler did not give us an exit_code')
-            exit_code = JOB_SUCCESS
+        try:
+            # 2) Log request
+            end_request_kwargs = start_request(repo_name=repo_name, revision=revision)
 
-        # 3) Submit results to Treeherder
-        end_request(exit_code=exit_code, data=data, **end_request_kwargs)
+            # 3) Process request
+            handler_error = None
+            try:
+                exit_code = handler(data=event, message=message, repo_name=repo_name,
+                                    revision=revision, **kwargs)
+            except MessageStateError as e:
+                # I'm trying to fix the improper use of requeue in a previous patch
+                LOG.warning(str(e))
+                exit_code = JOB_FAILURE
+            except KeyboardInterrupt:
+                raise
+            except:
+                LOG.exception('The handler failed to do is job. We will mark the job as failed')
+                handler_error = sys.exc_info()
+                exit_code = JOB_FAILURE
+
+            # XXX: Until handlers can guarantee an exit_code
+            if not exit_code:
+                LOG.warning('The handler did not give us an exit_code')
+                exit_code = JOB_SUCCESS
+
+            # 4) Submit results to Treeherder
+            end_request(exit_code=exit_code, data=data, **end_request_kwargs)
+        finally:
+            if lease is not None:
+                lease.release()
+
+        LOG.info(PUSH_INDEX.report())
         LOG.info('#### End of user request ####.')
 
+        # The caller decides if the request should be retried
+        if handler_error is not None:
+            raise handler_error[0], handler_error[1], handler_error[2]
 
-def run_listener(config_file):
+
+def run_listener(config_file, push_index=False):
     if 'PULSE_USER' not in os.environ or \
        'PULSE_PW' not in os.environ:
 
@@ -403,24 +709,160 @@ def run_listener(config_file):
                   'if running on dry run mode.')
         sys.exit(1)
 
+    if RETRY_STORE is not None:
+        RetryScheduler(store=RETRY_STORE, process_request=process_failed_request).start()
+
+    with open(config_file) as file:
+        queue_config = json.load(file)
+
+    if push_index:
+        start_push_index(queue_config)
+
+    if 'lanes' in queue_config:
+        run_lanes(config_file, queue_config)
+        return
+
+    def callback(data, message):
+        if not CONFIG['route']:
+            LOG.info("We're not routing messages")
+            return
+        acknowledge(message)
+        # Routing can take longer than a heartbeat; keep the connection alive meanwhile
+        manager.run_blocking(process_message, data, message)
+
     consumer = create_consumer(
         user=os.environ['PULSE_USER'],
         password=os.environ['PULSE_PW'],
         config_file_path=config_file,
-        process_message=message_handler,
+        process_message=callback,
     )
+    manager = ConnectionManager(consumer)
+    watch_config(config_file, queue_config, consumers=[(consumer, None)])
 
-    while True:
-        try:
-            consumer.listen()
-        except KeyboardInterrupt:
-            LOG.error('The user requested keyboard interruption')
-            # We want to get out of the loop
-            break
-        except ConsumerCancelled:
-            LOG.info('We have cleared the Pulse queue and need to restart')
-        except:
-            LOG.exception('CRITICAL: We should have caught this error earlier.')
+    try:
+        manager.run()
+    except KeyboardInterrupt:
+        LOG.error('The user requested keyboard interruption')
+
+
+def start_push_index(queue_config):
+    '''Feed the push index from the sources of the config's "index" section.'''
+    if 'index' not in queue_config:
+        LOG.error('The config file needs an "index" section to use --push-index')
+        sys.exit(1)
+
+    consumer = create_index_consumer(
+        user=os.environ['PULSE_USER'],
+        password=os.environ['PULSE_PW'],
+        index_config=queue_config['index'],
+    )
+    thread = threading.Thread(target=ConnectionManager(consumer).run, name='PushIndexConsumer')
+    thread.daemon = True
+    thread.start()
+
+
+def watch_config(config_file, queue_config, consumers, scheduler=None):
+    '''Reload the config file when it changes or on SIGHUP.
+
+    :param consumers: List of (consumer, name of its lane or None)
+    '''
+    def apply(old_config, new_config):
+        global CONFIG, JOB_FACTORY
+
+        changes = config_changes(old_config, new_config)
+        new_config_values = dict(CONFIG, **changes)
+        # Shadow mode keeps capturing the submissions whatever the server is
+        server_changed = new_config_values['treeherder_server_url'] != \
+            CONFIG['treeherder_server_url']
+        if new_config_values['submit_to_treeherder'] and SHADOW is None and \
+           (JOB_FACTORY is None or server_changed):
+            # It raises if the Treeherder credentials are missing; requests in flight keep
+            # the factory they started with (see start_request)
+            JOB_FACTORY = initialize_treeherder_submission(
+                server_url=new_config_values['treeherder_server_url'],
+                client=os.environ['TREEHERDER_CLIENT_ID'],
+                secret=os.environ['TREEHERDER_SECRET'],
+                dry_run=new_config_values['dry_run']
+            )
+
+        for consumer, lane in consumers:
+            update_bindings(consumer, bindings(new_config, lane))
+
+        if scheduler is not None:
+            scheduler.update_lanes(new_config['lanes'])
+
+        # Messages being processed keep the CONFIG they started with
+        CONFIG = new_config_values
+        for key, value in sorted(changes.iteritems()):
+            LOG.info('CONFIG[{!r}] is now {!r}'.format(key, value))
+
+    watcher = ConfigWatcher(path=config_file, config=queue_config, apply=apply)
+    watcher.install_signal_handler()
+    watcher.start()
+
+
+def run_lanes(config_file, queue_config):
+    '''Consume each lane from its own queue and process them with a shared pool.'''
+    managers = {}
+
+    def acknowledge_picked_up(lane, message):
+        # Messages have to be acknowledged from the thread consuming them
+        managers[lane.name].call_soon(acknowledge, message)
+
+    lanes = create_lanes(queue_config)
+    scheduler = LaneScheduler(
+        lanes=lanes,
+        process_message=process_message,
+        workers=queue_config.get('pulse_actions', {}).get(
+            'lane_workers', sum(lane.concurrency for lane in lanes)),
+        # Until then a restart or a crash leaves the message in the lane's queue
+        acknowledge=acknowledge_picked_up,
+    )
+    scheduler.start()
+
+    consumers = []
+    for lane in lanes:
+        def callback(data, message, lane=lane):
+            if not CONFIG['route']:
+                LOG.info("We're not routing messages")
+                return
+            # Keep the lane's connection alive while the lane is full
+            scheduler.put(lane, data, message, keepalive=managers[lane.name].keepalive)
+
+        consumer = create_lane_consumer(
+            user=os.environ['PULSE_USER'],
+            password=os.environ['PULSE_PW'],
+            queue_config=queue_config,
+            lane=lane,
+            callback=callback,
+        )
+        consumers.append((consumer, lane.name))
+        if lane.applabel is not None:
+            try:
+                unbind_other_lanes(consumer, queue_config, lane)
+            except Exception:
+                # e.g. the queue does not exist yet
+                LOG.warning('We could not clean up the bindings of %s', consumer.queue_name,
+                            exc_info=True)
+
+        # Pulse delivers the buffered messages again once we reconnect
+        managers[lane.name] = ConnectionManager(
+            consumer, on_disconnect=lambda lane=lane: scheduler.discard(lane))
+        thread = threading.Thread(target=managers[lane.name].run,
+                                  name='LaneConsumer-{}'.format(lane.name))
+        thread.daemon = True
+        thread.start()
+
+    watch_config(config_file, queue_config, consumers=consumers, scheduler=scheduler)
+
+    # Only the main thread receives the keyboard interruption
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        LOG.error('The user requested keyboard interruption')
+        LOG.info('{} messages left in the lanes will be delivered again.'.format(
+            scheduler.stop()))
 
 
 def parse_args(argv=None):
@@ -428,6 +870,10 @@ def parse_args(argv=None):
     parser.add_argument('--acknowledge', action="store_true", dest="acknowledge",
                         help="Acknowledge even if running on dry run mode.")
 
+    parser.add_argument('--builders-cache', dest="builders_cache", type=str,
+                        help="Directory where mozci's builders dataset is cached between "
+                             "restarts. It defaults to $BUILDERS_CACHE.")
+
     parser.add_argument('--config-file', dest="config_file", type=str)
 
     parser.add_argument('--debug', action="store_true", dest="debug",
@@ -444,15 +890,82 @@ def parse_args(argv=None):
                         help='It can be painful having to load all env variables. '
                              'This option will load them from env_variables.txt')
 
+    parser.add_argument('--json-logs', action='store_true', dest="json_logs",
+                        help='Write the console logs as JSON records. It can also be set '
+                             'with LOG_FORMAT=json.')
+
+    parser.add_argument('--leases', dest="leases", type=str,
+                        help='SQLite file or redis:// URL shared by the workers so only one '
+                             'of them acts on a push at a time. It defaults to $LEASES.')
+
+    parser.add_argument('--lease-wait', dest="lease_wait", type=float, default=LEASE_WAIT,
+                        help='Seconds before a request is processed again if another '
+                             'worker is acting on the same push.')
+
+    parser.add_argument('--list-retries', action='store_true', dest="list_retries",
+                        help='List the failed requests kept in --retry-store and exit.')
+
+    parser.add_argument('--memory-budget', dest="memory_budget", type=int,
+                        help='RSS ceiling in MB. Caches are shed before we get close to it. '
+                             'It defaults to $MEMORY_BUDGET.')
+
     parser.add_argument('--memory-saving', action='store_true', dest="memory_saving",
                         help='Enable memory saving. It is good for Heroku')
 
     parser.add_argument('--replay-file', dest="replay_file", type=str,
                         help='You can specify a file with saved pulse_messages to process')
 
+    parser.add_argument('--profile', action='store_true', dest="profile",
+                        help='Profile every message and keep the slowest ones. It can also '
+                             'be toggled at runtime with SIGUSR2.')
+
+    parser.add_argument('--profile-dir', dest="profile_dir", type=str, default=DEFAULT_DIR,
+                        help='Where profiles are written as folded stacks for flame graphs.')
+
+    parser.add_argument('--profile-keep', dest="profile_keep", type=int, default=KEEP_SLOWEST,
+                        help='How many of the slowest profiles to keep.')
+
+    parser.add_argument('--profile-threshold', dest="profile_threshold", type=float,
+                        help='Always keep the profiles of messages taking more seconds than this.')
+
+    parser.add_argument('--push-index', action='store_true', dest="push_index",
+                        help='Keep an index of pushes and jobs fed by the Pulse sources in '
+                             'the "index" section of --config-file so handlers can skip '
+                             'Treeherder queries.')
+
+    parser.add_argument('--purge-retries', action='store_true', dest="purge_retries",
+                        help='List and delete the failed requests kept in --retry-store.')
+
+    parser.add_argument('--replay-retries', action='store_true', dest="replay_retries",
+                        help='Process once every failed request kept in --retry-store.')
+
+    parser.add_argument('--retry-store', dest="retry_store", type=str,
+                        help='SQLite file where failed requests are kept to be retried '
+                             'with backoff. It defaults to $RETRY_STORE.')
+
+    parser.add_argument('--shadow', dest="shadow", type=str,
+                        help='Capture the side effects instead of executing them and write the '
+                             'intended actions and latency of each message to this file.')
+
+    parser.add_argument('--shadow-baseline', dest="shadow_baseline", type=str,
+                        help='Output of a previous --shadow run (e.g. of the deployed '
+                             'version on the same replay file) to compare against.')
+
     parser.add_argument('--submit-to-treeherder', action="store_true", dest="submit_to_treeherder",
                         help="Submit to treeherder even if running on dry run mode.")
 
+    parser.add_argument('--trace-allocations', action='store_true', dest="trace_allocations",
+                        help='Report the top allocations with --memory-budget. It slows down '
+                             'every allocation.')
+
+    parser.add_argument('--trigger-concurrency', dest="trigger_concurrency", type=int,
+                        default=trigger_executor.CONCURRENCY,
+                        help='How many BuildAPI triggers can be in flight at the same time.')
+
+    parser.add_argument('--trigger-rate', dest="trigger_rate", type=float,
+                        default=trigger_executor.RATE_LIMIT,
+                        help='How many BuildAPI triggers we can post per second.')
+
     parser.add_argument('--treeherder-server-url', dest="treeherder_server_url", type=str,
                         help='You can specify a treeherder server url to use instead of reading the '
                              'value from a config file.')
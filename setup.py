@@ -23,6 +23,8 @@ setup(name='pulse-actions',
       url='https://github.com/mozilla/pulse_actions',
       entry_points={
           'console_scripts': [
-              'run-pulse-actions = pulse_actions.worker:main'
+              'run-pulse-actions = pulse_actions.worker:main',
+              'pulse-actions-loadtest = pulse_actions.loadtest:main',
+              'pulse-actions-replay = pulse_actions.replay_runner:main',
               ],
           })
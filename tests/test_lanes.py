@@ -0,0 +1,70 @@
+import threading
+import unittest
+
+from pulse_actions.utils.lanes import Lane, LaneScheduler
+
+
+class LaneSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.acknowledged = []
+        self.processed = []
+        self.picked_up = threading.Event()
+        self.release = threading.Event()
+        self.lane = Lane('user', concurrency=1, max_pending=3)
+        self.scheduler = LaneScheduler(
+            lanes=[self.lane],
+            process_message=self.process_message,
+            workers=1,
+            acknowledge=lambda lane, message: self.acknowledged.append(message),
+        )
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.release.set()
+
+    def process_message(self, data, message):
+        self.picked_up.set()
+        self.release.wait(5)
+        self.processed.append(message)
+
+    def test_buffered_messages_are_not_acknowledged(self):
+        self.scheduler.start()
+        self.scheduler.put(self.lane, {}, 'first')
+        self.assertTrue(self.picked_up.wait(5))
+        for message in ('second', 'third', 'fourth'):
+            self.scheduler.put(self.lane, {}, message)
+
+        self.assertEqual(self.scheduler.stop(), 3)
+        self.release.set()
+        # The worker finishes its message and does not pick up another one
+        for thread in threading.enumerate():
+            if thread.name.startswith('LaneWorker-'):
+                thread.join(5)
+
+        self.assertEqual(self.acknowledged, ['first'])
+        self.assertEqual(self.processed, ['first'])
+        self.assertEqual([message for _, _, message in self.lane.pending],
+                         ['second', 'third', 'fourth'])
+
+    def test_put_does_not_block_a_stopped_scheduler(self):
+        for message in ('first', 'second', 'third'):
+            self.scheduler.put(self.lane, {}, message)
+        self.scheduler.stop()
+
+        self.scheduler.put(self.lane, {}, 'fourth')
+        self.assertEqual(self.acknowledged, [])
+        self.assertEqual(len(self.lane.pending), 4)
+
+    def test_discarded_messages_are_not_acknowledged(self):
+        self.scheduler.put(self.lane, {}, 'first')
+        self.scheduler.put(self.lane, {}, 'second')
+
+        self.assertEqual(self.scheduler.discard(self.lane), 2)
+        self.scheduler.start()
+        self.scheduler.put(self.lane, {}, 'third')
+        self.assertTrue(self.picked_up.wait(5))
+        self.assertEqual(self.acknowledged, ['third'])
+
+
+if __name__ == '__main__':
+    unittest.main()
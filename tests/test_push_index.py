@@ -0,0 +1,64 @@
+import sys
+import unittest
+
+from mock import Mock, patch
+
+from pulse_actions import worker
+from pulse_actions.utils.push_index import INDEX, lookup_job
+from pulse_actions.utils.schemas import JobAction
+
+JOB = {
+    'build_system_type': 'buildbot',
+    'id': 30210861,
+    'job_guid': 'cb4c4cf5fdb50bc6b03ec18f50dc19bdf4ce6811',
+    'job_type_name': 'Mochitest e10s Browser Chrome',
+    'ref_data_name':
+        'Rev7 MacOSX Yosemite 10.10.5 mozilla-inbound opt test mochitest-e10s-browser-chrome-2',
+    'result_set_id': 33460,
+    'state': 'completed',
+}
+RESULTSET = {'author': 'someone@mozilla.com', 'revision': 'abcdef123456'}
+
+
+class DetermineRepoRevisionTest(unittest.TestCase):
+    def setUp(self):
+        INDEX.clear()
+        self.treeherder_client = Mock()
+        self.treeherder_client.get_jobs.return_value = [JOB]
+        self.treeherder_client.get_resultsets.return_value = [RESULTSET]
+        misc = Mock()
+        misc.create_treeherder_client.return_value = self.treeherder_client
+        patcher = patch.dict(sys.modules, {'pulse_actions.utils.misc': misc})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(INDEX.clear)
+
+    def event(self):
+        return JobAction(project='mozilla-inbound', job_id=JOB['id'], action='backfill',
+                         requester='someone@mozilla.com')
+
+    def test_second_lookup_of_a_job_does_not_call_treeherder(self):
+        expected = ('mozilla-inbound', RESULTSET['revision'])
+        self.assertEqual(worker._determine_repo_revision(self.event(), 'https://th'), expected)
+        self.assertEqual(self.treeherder_client.get_jobs.call_count, 1)
+        self.assertEqual(self.treeherder_client.get_resultsets.call_count, 1)
+
+        self.assertEqual(worker._determine_repo_revision(self.event(), 'https://th'), expected)
+        self.assertEqual(self.treeherder_client.get_jobs.call_count, 1)
+        self.assertEqual(self.treeherder_client.get_resultsets.call_count, 1)
+
+    def test_handler_finds_the_job_in_the_index(self):
+        worker._determine_repo_revision(self.event(), 'https://th')
+
+        job = lookup_job(self.treeherder_client, 'mozilla-inbound', JOB['id'])
+        self.assertEqual(job.result_set_id, JOB['result_set_id'])
+        self.assertEqual(self.treeherder_client.get_jobs.call_count, 1)
+
+    def test_unknown_job(self):
+        self.treeherder_client.get_jobs.return_value = []
+        self.assertRaises(LookupError, worker._determine_repo_revision, self.event(),
+                          'https://th')
+
+
+if __name__ == '__main__':
+    unittest.main()